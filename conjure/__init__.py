@@ -2,6 +2,9 @@ from .documents import *
 from .exceptions import *
 from .eagerload import *
 from .fields import *
+from .session import *
+from .cache import *
+from .spec import Param
 from bson.objectid import ObjectId, InvalidId
 
 DOUBLE = 1
@@ -1,13 +1,233 @@
 from .operations import Common
 from .exceptions import ValidationError
 from .query import Manager
+from .diff import freeze
+from .updater import apply_update
 from operator import itemgetter
+from bson.raw_bson import RawBSONDocument
 import copy
 import bson
 
 _documents = []
 
 
+def _inflate(value):
+    if type(value) is RawBSONDocument:
+        return bson.BSON(value.raw).decode()
+
+    if isinstance(value, list):
+        return [_inflate(item) for item in value]
+
+    return value
+
+
+def _is_passthrough(method, *passthroughs):
+    return getattr(method, 'im_func', method) in [getattr(m, 'im_func', m) for m in passthroughs]
+
+
+def _compile_hydrator(fields):
+    converters = {}
+
+    for field in fields.itervalues():
+        converter = field.to_python
+
+        if _is_passthrough(converter, BaseField.to_python, ObjectIdField.to_python):
+            converter = None
+
+        converters[field.db_field] = (field.name, converter)
+
+    def hydrate(data, raw):
+        for db_field, value in raw.iteritems():
+            entry = converters.get(db_field)
+
+            if entry is None:
+                continue
+
+            name, converter = entry
+            data[name] = value if converter is None else converter(value)
+
+    return hydrate
+
+
+def _compile_choices(choices):
+    if choices and isinstance(choices[0], tuple):
+        choices = map(itemgetter(0), choices)
+
+    try:
+        return frozenset(choices)
+    except TypeError:
+        return list(choices)
+
+
+def _compile_validator(fields):
+    plan = tuple((name, field, field.required and not (isinstance(field, ObjectIdField) and name == 'id'))
+                 for name, field in fields.iteritems())
+
+    def validate(document, names=None):
+        for name, field, required in plan:
+            if names is not None and name not in names:
+                continue
+
+            value = getattr(document, name)
+
+            if value is not None:
+                try:
+                    field._validate(value)
+                except (ValueError, AttributeError, AssertionError):
+                    raise ValidationError('Invalid value for field %s of type "'%name +
+                                                     field.__class__.__name__ + '"')
+            elif required:
+                raise ValidationError('Field "%s" is required' % name)
+
+    return validate
+
+
+def _compile_dehydrator(fields):
+    converters = {}
+    names = dict((field.db_field, field.name) for field in fields.itervalues())
+
+    for field in fields.itervalues():
+        converter = field.to_mongo
+
+        if _is_passthrough(converter, BaseField.to_mongo) and \
+                _is_passthrough(field.to_python, BaseField.to_python, ObjectIdField.to_python):
+            converter = None
+
+        converters[field.name] = (field.db_field, converter)
+
+    def dehydrate(data, raw=None):
+        doc = {}
+
+        for name, value in data.iteritems():
+            if value is None:
+                continue
+
+            entry = converters.get(name)
+
+            if entry is None:
+                continue
+
+            db_field, converter = entry
+            doc[db_field] = value if converter is None else converter(value)
+
+        if raw is not None:
+            inflate = type(raw) is RawBSONDocument
+
+            for db_field, value in raw.iteritems():
+                name = names.get(db_field)
+
+                if name is not None and name not in data and value is not None:
+                    doc[db_field] = _inflate(value) if inflate else value
+
+        return doc
+
+    return dehydrate
+
+
+def _compile_serializer(fields):
+    converters = {}
+
+    for name, field in fields.iteritems():
+        converter = field.to_json
+
+        if _is_passthrough(converter, BaseField.to_json) and _is_passthrough(field.to_python, BaseField.to_python):
+            converter = None
+
+        converters[name] = (field, converter)
+
+    plans = {}
+
+    def compile_plan(only, external):
+        plan = []
+
+        for name in only or fields.keys():
+            field, converter = converters[name]
+
+            if not field.serialize or (field.internal and external):
+                continue
+
+            plan.append((name, converter))
+
+        return tuple(plan)
+
+    def serialize(document, only=None, external=False):
+        key = (tuple(only) if only else None, external)
+        plan = plans.get(key)
+
+        if plan is None:
+            plan = plans[key] = compile_plan(only, external)
+
+        j = {}
+
+        for name, converter in plan:
+            value = getattr(document, name)
+
+            if converter is not None:
+                value = converter(value, external=external)
+
+            if value is not None:
+                j[name] = value
+
+        return j
+
+    return serialize
+
+
+def _compile_setter(document_cls, name):
+    field = document_cls._fields[name]
+    from_val = field.from_val
+
+    def set_value(document, rest, value):
+        if not rest:
+            setattr(document, name, from_val(value))
+            return
+
+        container = document._container(name)
+
+        if type(container) is list:
+            _set_item(container, rest, value)
+            setattr(document, name, container)
+        elif type(container) is dict:
+            container[rest] = value
+            setattr(document, name, container)
+        else:
+            container.set_field(rest, value)
+
+    return set_value
+
+
+def _set_item(items, path, value):
+    index, _, rest = path.partition('.')
+    index = int(index)
+
+    if not rest:
+        items[index] = value
+    elif isinstance(items[index], BaseDocument):
+        items[index].set_field(rest, value)
+    else:
+        items[index][rest] = value
+
+
+def _set_items(items, values):
+    nested = {}
+
+    for path, value in values.iteritems():
+        index, _, rest = path.partition('.')
+
+        if rest:
+            nested.setdefault(index, {})[rest] = value
+        else:
+            items[int(index)] = value
+
+    for index, item_values in nested.iteritems():
+        item = items[int(index)]
+
+        if isinstance(item, BaseDocument):
+            item.set_fields(item_values)
+        else:
+            item.update(item_values)
+
+
 class DocumentMeta(type):
     def __new__(cls, name, bases, attrs):
         metaclass = attrs.get('__metaclass__')
@@ -27,7 +247,9 @@ class DocumentMeta(type):
             'collection': name.lower() + 's',
             'indexes': [],
             'embedded': False,
-            'track_changes': False
+            'track_changes': False,
+            'lazy': False,
+            'cache': None
         }
 
         for base in bases:
@@ -76,6 +298,8 @@ class DocumentMeta(type):
 
         attrs['_name'] = '.'.join(reversed(_name))
         attrs['_superclasses'] = _superclasses
+        attrs['_subclasses'] = {}
+        attrs['_setters'] = {}
         attrs['_meta'] = _meta
         attrs['_fields'] = _fields
 
@@ -85,6 +309,14 @@ class DocumentMeta(type):
             field.owner = new_cls
             field.add_to_document(new_cls)
 
+        new_cls._hydrate = staticmethod(_compile_hydrator(new_cls._fields))
+        new_cls._dehydrate = staticmethod(_compile_dehydrator(new_cls._fields))
+        new_cls._validator = staticmethod(_compile_validator(new_cls._fields))
+        new_cls._serializer = staticmethod(_compile_serializer(new_cls._fields))
+
+        for superclass in _superclasses.itervalues():
+            superclass._subclasses[new_cls._name] = new_cls
+
         if not _meta['embedded']:
             global _documents
             _documents.append(new_cls)
@@ -97,6 +329,11 @@ class BaseDocument(object):
 #    _fields = {}
 #    _meta = {}
 
+    _raw = None
+    _snapshots = None
+    _dirty = None
+    _siblings = None
+
     def __init__(self, **data):
         self._data = {}
         self._search_index = None
@@ -109,18 +346,7 @@ class BaseDocument(object):
 
     @classmethod
     def _get_subclasses(cls):
-        try:
-            subclasses = cls.__subclasses__()
-        except:
-            subclasses = cls.__subclasses__(cls)
-
-        all_subclasses = {}
-
-        for subclass in subclasses:
-            all_subclasses[subclass._name] = subclass
-            all_subclasses.update(subclass._get_subclasses())
-
-        return all_subclasses
+        return dict(cls._subclasses)
 
     def __iter__(self):
         return iter(self._fields)
@@ -164,65 +390,69 @@ class BaseDocument(object):
 
             return '%s object' % self.__class__.__name__
 
+    def _materialize(self):
+        if self._raw is not None:
+            for field in self._fields.itervalues():
+                field._load(self)
+
     @classmethod
-    def to_python(cls, data):
+    def to_python(cls, data, lazy=None):
         if data is not None:
             if '_cls' in data:
                 cls_name = data['_cls']
 
                 if cls_name != cls._name:
-                    subclasses = cls._get_subclasses()
+                    cls = cls._subclasses.get(cls_name)
 
-                    if cls_name not in subclasses:
+                    if cls is None:
                         return None
 
-                    cls = subclasses[cls_name]
-
             doc = cls()
 
-            for field in cls._fields.itervalues():
-                if field.db_field in data:
-                    doc._data[field.name] = field.to_python(data[field.db_field])
+            if type(data) is RawBSONDocument or (cls._meta.get('lazy') if lazy is None else lazy):
+                doc._raw = data
+            else:
+                cls._hydrate(doc._data, data)
 
-            if 'track_changes' in cls._meta and cls._meta['track_changes']:
-                doc._base = copy.deepcopy(doc)
+            if not cls._meta['embedded']:
+                doc._track(data)
 
             return doc
 
         return data
 
     def to_mongo(self):
-        doc = {}
-
-        for field_name, field in self._fields.iteritems():
-            value = self._data.get(field_name, None)
-
-            if value is not None:
-                doc[field.db_field] = field.to_mongo(value)
+        doc = self._dehydrate(self._data, self._raw)
 
         if self._superclasses:
             doc['_cls'] = self._name
 
         return doc
 
-    def to_json(self, only=None, methods=None, external=False):
-        j = {}
+    def to_bson(self):
+        raw = self._raw
 
-        only = only or self._fields.keys()
+        if type(raw) is RawBSONDocument and not self._raw_changed():
+            return raw.raw
 
-        for field_name in only:
-            field = self._fields[field_name]
+        return bson.BSON.encode(self.to_mongo())
 
-            if not field.serialize:
-                continue
+    def _raw_changed(self):
+        raw = self._raw
 
-            if field.internal and external:
-                continue
+        for field_name, value in self._data.iteritems():
+            field = self._fields[field_name]
 
-            value = field.to_json(getattr(self, field_name), external=external)
+            if field.db_field not in raw:
+                if value is not None:
+                    return True
+            elif value is None or field.to_mongo(value) != _inflate(raw[field.db_field]):
+                return True
 
-            if value is not None:
-                j[field_name] = value
+        return False
+
+    def to_json(self, only=None, methods=None, external=False):
+        j = self._serializer(self, only, external)
 
         if methods:
             for method in methods:
@@ -260,56 +490,100 @@ class BaseDocument(object):
                 deltas.update({field_name: field_deltas})
         return deltas
 
+    def _canonical(self):
+        return (self._name,) + tuple((name, field.canonical(getattr(self, name)))
+                                     for name, field in self._fields.iteritems())
+
+    @classmethod
+    def _setter(cls, name):
+        setter = cls._setters.get(name)
+
+        if setter is None:
+            setter = cls._setters[name] = _compile_setter(cls, name)
+
+        return setter
+
+    def _container(self, name):
+        field = self._fields[name]
+        value = getattr(self, name)
+
+        if value is None:
+            value = field.new_instance()
+            setattr(self, name, value)
+
+        return value
+
     def set_field(self, k, v):
-        k = k.split('.', 1)
-        field = k[0]
-        if len(k) == 2:
-            dot_string = k[1]
-            if getattr(self, field) is None:
-                setattr(self, field, self._fields[field].new_instance())
-            if type(getattr(self, field)) is list:
-                spl = dot_string.split('.', 1)
-                index = int(spl[0])
-                if len(spl) == 2:
-                    if len(spl[1].split('.',1)) == 2:
-                        self._fields[field].set_field(spl[1], v, getattr(self, field)[index])
-                    else:
-                        getattr(self, field)[index][spl[1]] = v
-                        setattr(self, field, getattr(self, field))
-                else:
-                    getattr(self, field)[index] = v
-                    setattr(self, field, getattr(self, field))
-            elif type(getattr(self, field)) is dict:
-                getattr(self, field)[k[1]] = v
-                setattr(self, field, getattr(self, field))
+        name, _, rest = k.partition('.')
+        self._setter(name)(self, rest, v)
+
+    def set_fields(self, values):
+        """Sets several dotted paths at once, resolving each shared prefix a single time."""
+        nested = {}
+
+        for path, value in values.iteritems():
+            name, _, rest = path.partition('.')
+
+            if rest:
+                nested.setdefault(name, {})[rest] = value
             else:
-                self._fields[field].set_field(dot_string, v, getattr(self, field))
-        else:
-            setattr(self, field, self._fields[field].from_val(v))
+                self._setter(name)(self, '', value)
+
+        for name, field_values in nested.iteritems():
+            container = self._container(name)
+
+            if type(container) is list:
+                _set_items(container, field_values)
+                setattr(self, name, container)
+            elif type(container) is dict:
+                container.update(field_values)
+                setattr(self, name, container)
+            else:
+                container.set_fields(field_values)
 
-    def validate(self):
-        fields = [(field, getattr(self, name), name) for name, field in self._fields.iteritems()]
+    def _apply_update(self, update, query=None):
+        doc = self.to_mongo()
+        fields = dict((field.db_field, field) for field in self._fields.itervalues())
+        applied = {}
+
+        for db_field in apply_update(doc, update, query):
+            field = fields.get(db_field)
+
+            if field is None:
+                continue
+
+            value = doc.get(db_field)
 
-        for field, value, name in fields:
             if value is not None:
-                try:
-                    field._validate(value)
-                except (ValueError, AttributeError, AssertionError):
-                    raise ValidationError('Invalid value for field %s of type "'%name +
-                                                     field.__class__.__name__ + '"')
-            elif not (isinstance(field, ObjectIdField) and field.name == 'id') and field.required:
-                raise ValidationError('Field "%s" is required' % field.name)
+                self._data[field.name] = field.to_python(value)
+            elif self._raw is not None and db_field in self._raw:
+                self._data[field.name] = None
+            else:
+                self._data.pop(field.name, None)
+
+            applied[field.name] = value
+
+        return applied
+
+    def validate(self, names=None):
+        self._validator(self, names)
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             if hasattr(self, 'id') and hasattr(other, 'id'):
                 return self.id == other.id
 
+            self._materialize()
+            other._materialize()
+
             return self._data == other._data
 
         return False
 
 
+MUTABLE_TYPES = (list, dict, BaseDocument)
+
+
 class BaseField(Common):
     def __init__(self, verbose_name=None, db_field=None, required=False, default=None, validators=None, choices=None,
                  editable=True, help_text='', serialize=True, internal=False):
@@ -322,6 +596,7 @@ class BaseField(Common):
         self.default = default
         self.validators = validators or []
         self.choices = choices or []
+        self._choices = _compile_choices(self.choices)
         self.editable = editable
         self.help_text = help_text
         self.serialize = serialize
@@ -350,23 +625,55 @@ class BaseField(Common):
 
         return self.db_field
 
+    def _load(self, instance):
+        value = instance._data.get(self.name)
+
+        if value is None and instance._raw is not None and self.name not in instance._data:
+            raw = instance._raw
+
+            if self.db_field in raw:
+                value = raw[self.db_field]
+
+                if type(raw) is RawBSONDocument:
+                    value = _inflate(value)
+
+                value = instance._data[self.name] = self.to_python(value)
+
+        return value
+
     def __get__(self, instance, _):
         if instance is None:
             return self
 
-        value = instance._data.get(self.name)
+        value = self._load(instance)
 
         if value is None:
             value = copy.deepcopy(self.get_default())
             instance._data[self.name] = value
 
+        snapshots = instance._snapshots
+
+        if snapshots is not None and self.name not in snapshots and isinstance(value, MUTABLE_TYPES):
+            instance._snapshot(self, value)
+
         return value
 
     def __set__(self, instance, value):
         instance._data[self.name] = value
 
+        if instance._dirty is not None:
+            instance._dirty.add(self.name)
+
     def __delete__(self, instance):
-        del instance._data[self.name]
+        raw = instance._raw
+
+        if raw is not None and self.db_field in raw:
+            instance._data[self.name] = None
+        else:
+            del instance._data[self.name]
+
+        if instance._dirty is not None:
+            instance._dirty.add(self.name)
 
     def has_default(self):
         return self.default is not None
@@ -400,16 +707,20 @@ class BaseField(Common):
             delta = {'old': base, 'new': cur}
         return delta
 
+    def canonical(self, value):
+        return freeze(value)
+
     def validate(self, value):
         pass
 
     def _validate(self, value):
-        if self.choices:
-            if len(self.choices) and isinstance(self.choices[0], tuple):
-                choices_list = map(itemgetter(0), self.choices)
-            else:
-                choices_list = self.choices
-            if value not in choices_list:
+        if self._choices:
+            try:
+                valid = value in self._choices
+            except TypeError:
+                valid = False
+
+            if not valid:
                 raise ValidationError('Field %s: Value %s must be one of %s.' % (self.name, value, unicode(self.choices)))
 
         for validator in self.validators:
@@ -423,7 +734,7 @@ class BaseField(Common):
             field = self
 
             def proxy(self):
-                value = self._data.get(name)
+                value = field._load(self)
 
                 for choice in field.choices:
                     if choice[0] == value:
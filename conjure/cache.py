@@ -0,0 +1,132 @@
+from .oplog_watcher import OplogWatcher
+from bson.raw_bson import RawBSONDocument
+import collections
+import threading
+import time
+import bson
+
+__all__ = ['Cache', 'LRUCache', 'CacheInvalidator']
+
+
+class Cache(object):
+    """Read-through cache for documents loaded by id, set per class with the `cache` Meta option."""
+
+    @staticmethod
+    def key(document_cls, object_id):
+        return document_cls._meta['db'], document_cls._meta['collection'], object_id
+
+    @staticmethod
+    def encode(data):
+        if isinstance(data, RawBSONDocument):
+            return data.raw
+
+        return bson.BSON.encode(data)
+
+    @staticmethod
+    def decode(value):
+        return RawBSONDocument(value)
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        values = {}
+
+        for key in keys:
+            value = self.get(key)
+
+            if value is not None:
+                values[key] = value
+
+        return values
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class LRUCache(Cache):
+    """In-process cache holding up to max_size documents for ttl seconds (forever when ttl is None)."""
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                return None
+
+            value, expires = entry
+
+            if expires is not None and expires < time.time():
+                return None
+
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheInvalidator(object):
+    """Evicts cached documents as updates and deletes to their collections show up in the oplog."""
+
+    def __init__(self, connection, document_classes, poll_time=1.0):
+        caches = collections.defaultdict(dict)
+
+        for document_cls in document_classes:
+            cache = document_cls._meta.get('cache')
+
+            if cache is not None:
+                namespace = document_cls.objects._collection.full_name
+                caches[namespace][id(cache)] = (document_cls, cache)
+
+        self.oplog_watcher = OplogWatcher(connection, namespaces=caches.keys(), poll_time=poll_time)
+
+        for namespace, targets in caches.iteritems():
+            evict = self._evictor(targets.values())
+
+            for op in ('update', 'delete'):
+                self.oplog_watcher.add_handler(namespace, op, evict)
+
+    @staticmethod
+    def _evictor(targets):
+        def evict(object_id, *args):
+            for document_cls, cache in targets:
+                cache.delete(cache.key(document_cls, object_id))
+
+        return evict
+
+    def start(self):
+        self.oplog_watcher.start()
@@ -0,0 +1,90 @@
+from collections import defaultdict, deque
+import bisect
+import time
+
+__all__ = ['freeze', 'timestamp', 'diff']
+
+
+def timestamp(value):
+    if value is None:
+        return None
+
+    return int(time.mktime(value.timetuple()))
+
+
+def freeze(value):
+    if hasattr(value, '_canonical'):
+        return value._canonical()
+
+    if isinstance(value, dict):
+        return dict, tuple(sorted((k, freeze(v)) for k, v in value.iteritems()))
+
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+
+    if isinstance(value, (set, frozenset)):
+        return frozenset(freeze(item) for item in value)
+
+    try:
+        hash(value)
+    except TypeError:
+        return repr, repr(value)
+
+    return value
+
+
+def _stable_indexes(indexes):
+    # Longest increasing subsequence, these elements can stay where they are.
+    tails = []
+    tail_positions = []
+    previous = [None] * len(indexes)
+
+    for position, index in enumerate(indexes):
+        i = bisect.bisect_left(tails, index)
+
+        if i:
+            previous[position] = tail_positions[i - 1]
+
+        if i == len(tails):
+            tails.append(index)
+            tail_positions.append(position)
+        else:
+            tails[i] = index
+            tail_positions[i] = position
+
+    stable = set()
+    position = tail_positions[-1] if tail_positions else None
+
+    while position is not None:
+        stable.add(indexes[position])
+        position = previous[position]
+
+    return stable
+
+
+def diff(cur, base):
+    """Returns the remove, insert and move operations that turn the base list into the current one."""
+    positions = defaultdict(deque)
+
+    for i, key in enumerate(base):
+        positions[key].append(i)
+
+    matched = []
+    inserts = []
+
+    for j, key in enumerate(cur):
+        queue = positions.get(key)
+
+        if queue:
+            matched.append((queue.popleft(), j))
+        else:
+            inserts.append(j)
+
+    removes = sorted(i for queue in positions.itervalues() for i in queue)
+    stable = _stable_indexes([i for i, _ in matched])
+
+    ops = [('remove', i) for i in removes]
+    ops.extend(('move', i, j) for i, j in matched if i not in stable)
+    ops.extend(('insert', j) for j in inserts)
+
+    return ops
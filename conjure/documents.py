@@ -1,11 +1,49 @@
-from .base import BaseDocument, DocumentMeta, ObjectIdField
-from .exceptions import OperationError
+from .base import BaseDocument, DocumentMeta, ObjectIdField, MUTABLE_TYPES, _inflate
+from .exceptions import OperationError, BulkOperationError, ValidationError
 from .query import Query
+from .session import current_session, current_unit_of_work, _bulk_write_failures
+from .spec import UpdateSpecification
+from bson.raw_bson import RawBSONDocument
+import pymongo
 import pymongo.errors
+from multiprocessing.pool import ThreadPool
+from collections import deque
+import itertools
 import copy
+import sys
+import bson
 
 __all__ = ['Document', 'EmbeddedDocument']
 
+_ABSENT = object()
+
+# Snapshot of a value that was read but not copied out of _raw, its base is still the raw value.
+_RAW_BASE = object()
+
+
+def _shares(value, raw_value):
+    if value is raw_value:
+        return True
+
+    if isinstance(value, BaseDocument):
+        if value._raw is raw_value:
+            return True
+
+        if not isinstance(raw_value, dict):
+            return False
+
+        fields = value._fields
+        return any(_shares(v, raw_value.get(fields[name].db_field))
+                   for name, v in value._data.iteritems() if isinstance(v, MUTABLE_TYPES))
+
+    if isinstance(value, list) and isinstance(raw_value, list):
+        return any(_shares(v, raw_v) for v, raw_v in itertools.izip(value, raw_value) if isinstance(v, MUTABLE_TYPES))
+
+    if isinstance(value, dict) and isinstance(raw_value, dict):
+        return any(_shares(v, raw_value.get(k)) for k, v in value.iteritems() if isinstance(v, MUTABLE_TYPES))
+
+    return False
+
 
 class Document(BaseDocument):
     __metaclass__ = DocumentMeta
@@ -13,17 +51,201 @@ class Document(BaseDocument):
     id = ObjectIdField(db_field='_id')
     objects = Query(None, None)
 
-    _base = {}
+    _base_document = None
 
     def __init__(self, **data):
         super(Document, self).__init__(**data)
+
+        if data and self._meta['track_changes']:
+            self._base_document = copy.deepcopy(self)
+
+    @property
+    def _base(self):
+        if self._base_document is None:
+            if self._snapshots is None:
+                self._base_document = self.__class__()
+            else:
+                self._base_document = self.__class__.to_python(self._baseline(), lazy=True)
+                self._base_document._snapshots = None
+
+        return self._base_document
+
+    def _track(self, raw):
+        self._raw = raw
+        self._snapshots = {}
+        self._dirty = set()
+
+    def _snapshot(self, field, value):
+        raw = self._raw
+
+        if raw is not None and field.db_field in raw:
+            raw_value = raw[field.db_field]
+
+            # Values hydrated into new objects leave the raw data intact, it is compared against when saving.
+            # Only values still holding containers of a plain dict raw could change it and need a copy.
+            if type(raw) is RawBSONDocument or not _shares(value, raw_value):
+                self._snapshots[field.name] = _RAW_BASE
+                return
+
+            value = raw_value
+        elif field.name in self._dirty:
+            self._snapshots[field.name] = None
+            return
+        else:
+            value = field.to_mongo(value)
+
+        self._snapshots[field.name] = bson.BSON.encode({'value': value})
+
+    def _baseline(self):
+        raw = self._raw
+
+        if raw is None:
+            baseline = {}
+        elif type(raw) is RawBSONDocument:
+            baseline = bson.BSON(raw.raw).decode()
+        else:
+            baseline = dict(raw)
+
+        for field_name, snapshot in self._snapshots.iteritems():
+            db_field = self._fields[field_name].db_field
+
+            if snapshot is _RAW_BASE:
+                continue
+            elif snapshot is None:
+                baseline.pop(db_field, None)
+            else:
+                baseline[db_field] = bson.BSON(snapshot).decode()['value']
+
+        return baseline
+
+    def _base_value(self, field):
+        snapshot = self._snapshots.get(field.name, _RAW_BASE)
+
+        if snapshot is not _RAW_BASE:
+            return _ABSENT if snapshot is None else bson.BSON(snapshot).decode()['value']
+
+        raw = self._raw
+
+        if raw is not None and field.db_field in raw:
+            return _inflate(raw[field.db_field])
+
+        return _ABSENT
+
+    def _changes(self):
+        changes = {}
+
+        for field_name in self._dirty.union(self._snapshots):
+            field = self._fields[field_name]
+            base = self._base_value(field)
+            value = self._data.get(field_name)
+
+            if value is None:
+                if base is not _ABSENT:
+                    changes[field_name] = None
+                continue
+
+            value = field.to_mongo(value)
+
+            if base is _ABSENT or value != base:
+                changes[field_name] = (value, base)
+
+        return changes
+
+    def _update_spec(self, changes):
+        expressions = {}
+
+        for field_name, change in changes.iteritems():
+            db_field = self._fields[field_name].db_field
+
+            if change is None:
+                expressions['unset:' + db_field] = 1
+                continue
+
+            value, base = change
+
+            if isinstance(value, list) and isinstance(base, list) and len(value) == len(base):
+                changed = [i for i in xrange(len(value)) if value[i] != base[i]]
+
+                if len(changed) == 1:
+                    expressions['set:%s.%d' % (db_field, changed[0])] = value[changed[0]]
+                    continue
+
+            expressions['set:' + db_field] = value
+
+        return UpdateSpecification(expressions)
+
+    def _reset_changes(self, changes):
         if self._meta['track_changes']:
-            self._base = copy.deepcopy(self)
-            
+            self._base_document = self._base
+
+        for field_name, change in changes.iteritems():
+            if change is None:
+                self._snapshots[field_name] = None
+            else:
+                self._snapshots[field_name] = bson.BSON.encode({'value': change[0]})
+
+        self._dirty.clear()
+
+        if changes:
+            self._evict()
+
+    def _apply_update(self, update, query=None):
+        applied = super(Document, self)._apply_update(update, query)
+
+        if not self._is_new():
+            # The server already holds the updated values, so they become the baseline rather than pending changes.
+            for field_name, value in applied.iteritems():
+                self._snapshots[field_name] = None if value is None else bson.BSON.encode({'value': value})
+                self._dirty.discard(field_name)
+
+            if self._meta['track_changes']:
+                self._base_document = None
+
+        if applied:
+            self._evict()
+
+        return applied
+
+    def _is_new(self):
+        return self._snapshots is None
+
+    def _touched(self):
+        if self._is_new():
+            return None
+
+        return self._dirty.union(self._changes())
+
+    @classmethod
+    def validate_many(cls, documents):
+        """Validates each document, returning the ValidationError raised for each one (None when valid)."""
+        errors = []
+
+        for document in documents:
+            try:
+                document.validate(document._touched())
+            except ValidationError, e:
+                errors.append(e)
+            else:
+                errors.append(None)
+
+        return errors
 
     def save(self, insert=False):
-        self.validate()
+        if insert or self._is_new():
+            self.validate()
+        else:
+            self.validate(self._touched())
 
+        unit_of_work = current_unit_of_work()
+
+        if unit_of_work is not None:
+            unit_of_work.save(self, insert)
+        elif insert or self._is_new():
+            self._save(insert)
+        else:
+            self._save_changes()
+
+    def _save(self, insert):
         doc = self.to_mongo()
 
         try:
@@ -36,9 +258,163 @@ class Document(BaseDocument):
         except pymongo.errors.OperationFailure, err:
             raise OperationError(unicode(err))
 
+        self._saved(doc, object_id)
+
+    def _insert_document(self):
+        doc = self.to_mongo()
+
+        if '_id' not in doc and isinstance(self._fields['id'], ObjectIdField):
+            doc['_id'] = bson.objectid.ObjectId()
+
+        return doc
+
+    @staticmethod
+    def _prepare_insert(document):
+        document.validate()
+        return document._insert_document()
+
+    @classmethod
+    def insert_many(cls, documents, ordered=False, batch_size=1000, in_flight=2):
+        """Inserts documents with insert_many in chunks of batch_size and assigns their ids back."""
+        collection = cls.objects._collection
+        documents = iter(documents)
+        in_flight = 1 if ordered else max(in_flight, 1)
+        pool = ThreadPool(in_flight)
+        pending = deque()
+        errors = []
+
+        def finish():
+            chunk, docs, result = pending.popleft()
+
+            try:
+                result.get()
+            except pymongo.errors.BulkWriteError, err:
+                failed = _bulk_write_failures(err)
+                first_failure = min(failed)
+
+                for i, (document, doc) in enumerate(zip(chunk, docs)):
+                    if i in failed:
+                        errors.append((document, OperationError(failed[i])))
+                    elif not ordered or i < first_failure:
+                        document._saved(doc, doc.get('_id'))
+
+                if ordered:
+                    raise BulkOperationError(errors)
+
+                return
+            except pymongo.errors.OperationFailure, err:
+                raise OperationError(unicode(err))
+
+            for document, doc in zip(chunk, docs):
+                document._saved(doc, doc.get('_id'))
+
+        try:
+            while True:
+                chunk = list(itertools.islice(documents, batch_size))
+
+                if not chunk:
+                    break
+
+                try:
+                    docs = map(cls._prepare_insert, chunk)
+                except ValidationError:
+                    exc_info = sys.exc_info()
+
+                    while pending:
+                        finish()
+
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                if len(pending) == in_flight:
+                    finish()
+
+                pending.append((chunk, docs, pool.apply_async(collection.insert_many, (docs,), {'ordered': ordered})))
+
+            while pending:
+                finish()
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise BulkOperationError(errors)
+
+    def _saved(self, doc, object_id):
         self['id'] = object_id
 
+        if self._meta['track_changes']:
+            self._base_document = self._base
+
+        self._track(doc)
+
+        for field_name, field in self._fields.iteritems():
+            value = self._data.get(field_name)
+
+            if isinstance(value, MUTABLE_TYPES):
+                self._snapshot(field, value)
+
+        session = current_session()
+
+        if session is not None:
+            session.add(self)
+
+        self._evict()
+
+    def _evict(self):
+        cache = self._meta.get('cache')
+
+        if cache is not None and self.id is not None:
+            #noinspection PyUnresolvedReferences
+            cache.delete(cache.key(self.__class__, self._fields['id'].to_mongo(self.id)))
+
+    def _save_changes(self):
+        changes = self._changes()
+
+        if changes:
+            #noinspection PyUnresolvedReferences
+            object_id = self._fields['id'].to_mongo(self.id)
+            self.__class__.objects.filter_by(id=object_id).update_one(self._update_spec(changes))
+
+        self._reset_changes(changes)
+
+    def _write_request(self, insert=False):
+        """Returns the bulk write request saving this document (None when unchanged), what it sends and a callback."""
+        if insert or self._is_new():
+            doc = self._insert_document()
+
+            if insert or '_id' not in doc:
+                request = pymongo.InsertOne(doc)
+            else:
+                request = pymongo.ReplaceOne({'_id': doc['_id']}, doc, upsert=True)
+
+            return request, doc, lambda: self._saved(doc, doc.get('_id'))
+
+        changes = self._changes()
+
+        if not changes:
+            return None, None, lambda: self._reset_changes(changes)
+
+        #noinspection PyUnresolvedReferences
+        object_id = self._fields['id'].to_mongo(self.id)
+        update = self._update_spec(changes).compile()
+        request = pymongo.UpdateOne(self.__class__.objects.filter_by(id=object_id)._compile_spec(), update)
+
+        return request, update, lambda: self._reset_changes(changes)
+
+    def _delete_request(self):
+        #noinspection PyUnresolvedReferences
+        object_id = self._fields['id'].to_mongo(self.id)
+        request = pymongo.DeleteOne(self.__class__.objects.filter_by(id=object_id)._compile_spec())
+
+        return request, None, self._deleted
+
     def delete(self):
+        unit_of_work = current_unit_of_work()
+
+        if unit_of_work is not None:
+            unit_of_work.delete(self)
+            return
+
         #noinspection PyUnresolvedReferences
         object_id = self._fields['id'].to_mongo(self.id)
 
@@ -47,13 +423,25 @@ class Document(BaseDocument):
         except pymongo.errors.OperationFailure, err:
             raise OperationError(unicode(err))
 
+        self._deleted()
+
+    def _deleted(self):
+        session = current_session()
+
+        if session is not None:
+            session.remove(self)
+
+        self._evict()
+
     def reload(self):
         data = self.__class__.objects.filter_by(id=self.id)._one()
 
-        #noinspection PyUnresolvedReferences
-        for field in self.__class__._fields.values():
-            if field.db_field in data:
-                self._data[field.name] = field.to_python(data[field.db_field])
+        if self._meta['track_changes']:
+            self._base_document = self._base
+
+        self._data = {}
+        self._hydrate(self._data, data)
+        self._track(data)
 
     @classmethod
     def drop_collection(cls):
@@ -1,15 +1,135 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from .connection import gevent
 from .exceptions import EagerloadException
+from .operations import Reference
+from .session import current_session
+from multiprocessing.pool import ThreadPool
+import threading
+import weakref
+import os
 
-__all__ = ['Eagerload']
+__all__ = ['Eagerload', 'EagerloadPlan']
 
 ITERABLE_TYPES = (tuple, list, set)
 ITERABLE_FIELDS = {'ListField', 'MapField'}
 
+# Most eagerload queries run at the same time by the shared thread pool.
+EAGERLOAD_WORKERS = 4
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _thread_pool():
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        # Pool threads do not survive a fork, children start their own pool.
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(EAGERLOAD_WORKERS)
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def _use_gevent():
+    if gevent is None:
+        return False
+
+    # Greenlets only overlap their queries once sockets are patched, otherwise threads are used.
+    from gevent import monkey
+    return monkey.is_module_patched('socket')
+
+
+def _flush_all(eagerloads):
+    if len(eagerloads) < 2:
+        for eagerload in eagerloads:
+            eagerload.flush()
+
+        return
+
+    # Workers have their own thread (or greenlet) locals, the caller's session is entered in each of them.
+    session = current_session()
+
+    def flush(eagerload):
+        if session is None:
+            return eagerload.flush()
+
+        with session:
+            return eagerload.flush()
+
+    if _use_gevent():
+        gevent.joinall([gevent.spawn(flush, eagerload) for eagerload in eagerloads], raise_error=True)
+    else:
+        _thread_pool().map(flush, eagerloads)
+
+
+def _containers(document, attr):
+    documents = [document]
+
+    if attr:
+        for name in attr.split('.'):
+            found = []
+
+            for doc in documents:
+                value = getattr(doc, name, None)
+
+                if isinstance(value, dict):
+                    found.extend(value.itervalues())
+                elif isinstance(value, ITERABLE_TYPES):
+                    found.extend(value)
+                elif value is not None:
+                    found.append(value)
+
+            documents = found
+
+    return documents
+
+
+def _targets(document_cls, path):
+    if not isinstance(path, basestring):
+        return [TargetField(path)]
+
+    targets = []
+    attrs = []
+    fields = document_cls._fields
+
+    for name in path.split('.'):
+        field = fields.get(name)
+        inner = field.field if field.__class__.__name__ in ITERABLE_FIELDS else field
+
+        if isinstance(inner, Reference):
+            targets.append(TargetField(field, '.'.join(attrs + [name])))
+            fields = inner.document_cls._fields
+            attrs = []
+        elif inner.__class__.__name__ == 'EmbeddedDocumentField':
+            attrs.append(name)
+            fields = inner.document._fields
+        else:
+            raise EagerloadException('Cannot eagerload "%s", "%s" is not a reference' % (path, name))
+
+    if attrs:
+        raise EagerloadException('Cannot eagerload "%s", it does not end with a reference' % path)
+
+    return targets
+
+
+def _applies(field, document_cls):
+    owner = getattr(field, 'owner', None)
+
+    if not isinstance(owner, type):
+        return True
+
+    return issubclass(document_cls, owner) or issubclass(owner, document_cls)
+
 
 class TargetField(object):
-    def __init__(self, field):
-        key = field.get_key()
+    def __init__(self, field, key=None):
+        if key is None:
+            key = field.get_key()
+
+        self.key = key
 
         try:
             self.field_attr = key[:key.rindex('.')]
@@ -27,6 +147,28 @@ class TargetField(object):
             self.id_attr = field.name + '_id'
             self.iterable = False
 
+    def loaded(self, documents):
+        """Returns the documents this field references from documents, once they have been loaded."""
+        loaded = OrderedDict()
+
+        for document in documents:
+            for doc in _containers(document, self.field_attr):
+                value = doc._data.get(self.name)
+
+                if value is None:
+                    continue
+
+                if not self.iterable:
+                    value = [value]
+                elif isinstance(value, dict):
+                    value = value.itervalues()
+
+                for item in value:
+                    if hasattr(item, '_fields'):
+                        loaded[id(item)] = item
+
+        return loaded.values()
+
 
 class Eagerload(object):
     def __init__(self, only=None):
@@ -57,18 +199,24 @@ class Eagerload(object):
 
     def add_document(self, document):
         for field in self.fields:
-            if field.field_attr:
-                documents = getattr(document, field.field_attr)
-                if not isinstance(documents, ITERABLE_TYPES):
-                    documents = [documents]
-            else:
-                documents = [document]
-
-            for doc in documents:
+            for doc in _containers(document, field.field_attr):
                 self._add_document(field, doc)
 
         return self
 
+    def add_target(self, target, documents):
+        """Adds a field of the documents to load, for those documents only."""
+        if self.document_cls is None:
+            self.document_cls = target.document_cls
+
+        self.fields.append(target)
+
+        for document in documents:
+            for doc in _containers(document, target.field_attr):
+                self._add_document(target, doc)
+
+        return self
+
     def _add_document(self, field, document):
         try:
             ids = getattr(document, field.id_attr)
@@ -95,7 +243,20 @@ class Eagerload(object):
 
         mapping = self.mapping
         cls = self.document_cls
-        ids = mapping.keys()
+        session = current_session()
+        ids = []
+
+        for object_id, targets in mapping.iteritems():
+            document = session.get(cls, object_id) if session is not None else None
+
+            if document is None:
+                ids.append(object_id)
+            else:
+                for key, data in targets:
+                    data[key] = document
+
+        if not ids:
+            return
 
         cursor = cls.objects.filter(cls.id == ids[0] if len(ids) == 1 else cls.id.in_(ids))
 
@@ -103,5 +264,88 @@ class Eagerload(object):
             cursor.only(*self.only)
 
         for document in cursor:
-            for key, data in mapping[document._data['id']]:
-                data[key] = document
\ No newline at end of file
+            for key, data in mapping[document.id]:
+                data[key] = document
+
+
+class EagerloadPlan(object):
+    """The references Query.eagerload() loads, given as fields or dotted paths that may cross several references."""
+
+    def __init__(self, document_cls, paths, only=None):
+        self.only = only
+        self.targets = OrderedDict()
+
+        for path in paths:
+            node = self.targets
+
+            for target in _targets(document_cls, path):
+                if target.key not in node:
+                    node[target.key] = (target, OrderedDict())
+
+                node = node[target.key][1]
+
+    def _only(self, document_cls, children):
+        if self.only is None:
+            return None
+
+        only = [field for field in self.only if _applies(field, document_cls)]
+
+        if not only:
+            return None
+
+        return only + [target.key.partition('.')[0] for target, _ in children]
+
+    def load(self, documents):
+        if not isinstance(documents, ITERABLE_TYPES):
+            documents = [documents]
+
+        level = [(documents, self.targets)]
+
+        while level:
+            eagerloads = OrderedDict()
+            branches = []
+
+            for docs, node in level:
+                for target, children in node.itervalues():
+                    if target.document_cls not in eagerloads:
+                        eagerloads[target.document_cls] = (Eagerload(), [])
+
+                    eagerload, nested = eagerloads[target.document_cls]
+                    eagerload.add_target(target, docs)
+                    nested.extend(children.itervalues())
+
+                    if children:
+                        branches.append((target, docs, children))
+
+            for document_cls, (eagerload, nested) in eagerloads.iteritems():
+                eagerload.only = self._only(document_cls, nested)
+
+            _flush_all([eagerload for eagerload, _ in eagerloads.itervalues()])
+
+            level = [(target.loaded(docs), children) for target, docs, children in branches]
+
+        return documents
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class SiblingLoader(object):
+    """Shared by the documents read from the same cursor batch."""
+
+    def __init__(self):
+        self._refs = []
+
+    def __len__(self):
+        return len(self._refs)
+
+    @property
+    def documents(self):
+        return [document for document in (ref() for ref in self._refs) if document is not None]
+
+    def add(self, document):
+        document._siblings = self
+        self._refs.append(weakref.ref(document))
+
+    def __deepcopy__(self, memo):
+        return self
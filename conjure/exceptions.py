@@ -1,5 +1,5 @@
 __all__ = ['DocumentError', 'ConnectionError', 'ValidationError', 'OperationError',
-           'DoesNotExist', 'InvalidQueryError']
+           'BulkOperationError', 'DoesNotExist', 'InvalidQueryError']
 
 
 class DocumentError(Exception):
@@ -18,6 +18,12 @@ class OperationError(DocumentError):
     pass
 
 
+class BulkOperationError(OperationError):
+    def __init__(self, errors):
+        OperationError.__init__(self, '%d document(s) could not be written' % len(errors))
+        self.errors = errors
+
+
 class DoesNotExist(DocumentError):
     pass
 
@@ -1,8 +1,9 @@
-import time
 from .base import BaseField, ObjectIdField
 from .operations import String, Number, Common, List, Reference
 from .exceptions import ValidationError
 from .documents import Document
+from .diff import freeze, timestamp, diff
+from .session import current_session
 import re
 import datetime
 import dateutil.parser
@@ -14,6 +15,9 @@ __all__ = ['ObjectIdField', 'GenericField', 'StringField', 'EmailField', 'Intege
 
 ObjectIdField = ObjectIdField
 
+# Most ids sent in a single $in query when dereferencing lists of references.
+DEREFERENCE_BATCH_SIZE = 1000
+
 
 class GenericField(BaseField):
     pass
@@ -130,15 +134,15 @@ class DateTimeField(BaseField):
 
     def to_json(self, value, external=False):
         if isinstance(value, datetime.datetime):
-            return int(time.mktime(value.timetuple()))
+            return timestamp(value)
 
     def from_json(self, j, cur_val, update=False):
         deltas = {}
 
         dt = None if j is None else datetime.datetime.fromtimestamp(j)
 
-        dt_compare = int(time.mktime(dt.timetuple())) if dt else None
-        cur_val_compare = int(time.mktime(cur_val.timetuple())) if cur_val else None
+        dt_compare = self.canonical(dt)
+        cur_val_compare = self.canonical(cur_val)
         if dt_compare != cur_val_compare:
             deltas = {
                 'old': cur_val_compare,
@@ -149,8 +153,8 @@ class DateTimeField(BaseField):
 
     def deltas(self, cur, base):
         delta = {}
-        dt_compare = int(time.mktime(base.timetuple())) if base else None
-        cur_val_compare = int(time.mktime(cur.timetuple())) if cur else None
+        dt_compare = self.canonical(base)
+        cur_val_compare = self.canonical(cur)
         if dt_compare != cur_val_compare:
             delta = {
                 'old': cur_val_compare,
@@ -158,6 +162,9 @@ class DateTimeField(BaseField):
             }
         return delta
 
+    def canonical(self, value):
+        return timestamp(value) if value else None
+
     @classmethod
     def from_val(cls, v):
         if not v:
@@ -210,7 +217,7 @@ class DictField(BaseField):
         json_dict = {}
         for k,v in value.iteritems():
             if isinstance(v, datetime.datetime):
-                json_dict[k] = int(time.mktime(v.timetuple()))
+                json_dict[k] = timestamp(v)
             else:
                 json_dict[k] = v
         return json_dict
@@ -219,6 +226,13 @@ class DictField(BaseField):
         return {}
 
 
+def _convert_json(value):
+    try:
+        return value.to_json()
+    except:
+        return value
+
+
 class ListField(List, BaseField):
     def __init__(self, field, default=None, **kwargs):
         if not isinstance(field, BaseField):
@@ -233,27 +247,24 @@ class ListField(List, BaseField):
             return self
 
         if isinstance(self.field, ReferenceField):
-            referenced_cls = self.field.document_cls
-            lazyload_only = self.field._lazyload_only
-
-            value_list = instance._data.get(self.name)
+            value_list = self._load(instance)
 
             if value_list:
-                deref_list = []
+                object_ids = [value for value in value_list if value is not None and not isinstance(value, Document)]
 
-                for value in value_list:
-                    if not isinstance(value, Document):
-                        if value is not None:
-                            q = referenced_cls.objects.filter_by(id=value)
+                if object_ids:
+                    documents = self.field._dereference_many(object_ids)
+                    to_mongo = self.field.to_mongo
+                    deref_list = []
 
-                            if lazyload_only:
-                                q = q.only(*lazyload_only)
+                    for value in value_list:
+                        if not isinstance(value, Document):
+                            if value is not None:
+                                deref_list.append(documents.get(to_mongo(value)))
+                        else:
+                            deref_list.append(value)
 
-                            deref_list.append(q.one())
-                    else:
-                        deref_list.append(value)
-
-                instance._data[self.name] = deref_list
+                    instance._data[self.name] = deref_list
 
         return BaseField.__get__(self, instance, owner)
 
@@ -289,56 +300,53 @@ class ListField(List, BaseField):
         return cur_val, deltas
 
     def deltas(self, cur, base):
-        def _convert_json(_x):
-            try:
-                return _x.to_json()
-            except:
-                return _x
+        cur = cur or []
+        base = base or []
 
-        if not cur:
-            cur = []
-        if not base:
-            base = []
-
-        cur_list = [_convert_json(x) for x in cur]
-        base_list = [_convert_json(x) for x in base]
+        cur_keys = [self.field.canonical(x) for x in cur]
+        base_keys = [self.field.canonical(x) for x in base]
+        cur_set = set(cur_keys)
+        base_set = set(base_keys)
 
         deltas = {
-            'added': [_convert_json(x) for x in cur if _convert_json(x) not in base_list],
-            'removed': [_convert_json(x) for x in base if _convert_json(x) not in cur_list]
+            'added': [_convert_json(x) for x, key in zip(cur, cur_keys) if key not in base_set],
+            'removed': [_convert_json(x) for x, key in zip(base, base_keys) if key not in cur_set]
         }
 
         if not deltas['added'] and not deltas['removed']:
             deltas = {}
 
-        for i in range(max(len(cur),len(base) if base else 0)):
-            delta = self.field.deltas(cur[i] if i < len(cur) else None, base[i] if base and i < len(base) else None)
+        for i in range(max(len(cur), len(base))):
+            if i < len(cur) and i < len(base) and cur_keys[i] == base_keys[i]:
+                continue
+
+            delta = self.field.deltas(cur[i] if i < len(cur) else None, base[i] if i < len(base) else None)
             if delta:
                 deltas[str(i)]=delta
         return deltas
 
+    def diff(self, cur, base):
+        cur = cur or []
+        base = base or []
 
-    def set_field(self, k, v, cur_val):
-        if not cur_val:
-            cur_val = self.document()
-        k = k.split('.', 1)
-        field = k[0]
-        if type(getattr(cur_val, field)) is list:
-            dot_string = k[1]
-            spl = dot_string.split('.', 1)
-            index = int(spl[0])
-            if len(spl) == 2:
-                cur_val._fields[field].set_field(spl[1], v, getattr(cur_val, field)[index])
+        ops = []
+
+        for op in diff([self.field.canonical(x) for x in cur], [self.field.canonical(x) for x in base]):
+            if op[0] == 'remove':
+                ops.append({'op': 'remove', 'index': op[1], 'value': _convert_json(base[op[1]])})
+            elif op[0] == 'insert':
+                ops.append({'op': 'insert', 'index': op[1], 'value': _convert_json(cur[op[1]])})
             else:
-                getattr(cur_val, field)[index] = v
-                setattr(cur_val, field, getattr(cur_val, field))
-        elif len(k) == 2:
-            dot_string = k[1]
-            if getattr(cur_val, field) is None:
-                setattr(cur_val, field, cur_val._fields[field].document())
-            cur_val._fields[field].set_field(dot_string, v, getattr(cur_val, k[0]))
-        else:
-            setattr(cur_val, field, cur_val._fields[field].from_val(v))
+                ops.append({'op': 'move', 'from': op[1], 'to': op[2]})
+
+        return ops
+
+    def canonical(self, value):
+        return tuple(self.field.canonical(x) for x in value or [])
+
+
+    def set_field(self, k, v, cur_val):
+        cur_val.set_field(k, v)
 
     def validate(self, value):
         if not isinstance(value, (list, tuple)):
@@ -354,9 +362,10 @@ class ListField(List, BaseField):
             return
 
         name = self.name
+        field = self
 
         def proxy(self):
-            value_list = self._data.get(name) or []
+            value_list = field._load(self) or []
 
             if value_list:
                 for i, value in enumerate(value_list):
@@ -392,6 +401,9 @@ class MapField(BaseField):
         value = value or {}
         return dict((k, self.field.to_json(item, external=external)) for k, item in value.iteritems())
 
+    def canonical(self, value):
+        return dict, tuple(sorted((k, self.field.canonical(item)) for k, item in (value or {}).iteritems()))
+
     def validate(self, value):
         if not isinstance(value, dict):
             raise ValidationError('Only dict may be used in a map field')
@@ -415,8 +427,8 @@ class MapField(BaseField):
                     for e in expressions:
                         def wrap(name):
                             if e.is_query():
-                                left, _, right = name.partition(self.field.name)
-                                return left + self.get_key(False) + right
+                                left, _, right = name.path.partition(self.field.name)
+                                return name._replace(path=left + self.get_key(False) + right)
                             elif e.is_update():
                                 left, _, right = name.rpartition(self.field.name)
                                 return left + self.get_key(True) + right
@@ -516,6 +528,9 @@ class EmbeddedDocumentField(BaseField):
         if not cur:
             return deltas
 
+        if base and self.canonical(cur) == self.canonical(base):
+            return deltas
+
         for field_name in self.document._fields.keys():
             field = self.document._fields[field_name]
 
@@ -526,22 +541,17 @@ class EmbeddedDocumentField(BaseField):
 
         return deltas
 
+    def canonical(self, value):
+        if isinstance(value, self.document):
+            return value._canonical()
+
+        return freeze(value)
+
     def set_field(self, k, v, cur_val):
         if not cur_val:
             cur_val = self.document()
-        k = k.split('.', 1)
-        field = k[0]
-        if len(k) == 2:
-            dot_string = k[1]
-            if getattr(cur_val, field) is None:
-                setattr(cur_val, field, cur_val._fields[field].new_instance())
-            if type(getattr(cur_val, field)) is dict:
-                getattr(cur_val, field)[k[1]] = v
-                setattr(cur_val, field, getattr(cur_val, field))
-            else:
-                cur_val._fields[field].set_field(dot_string, v, getattr(cur_val, k[0]))
-        else:
-            setattr(cur_val, field, cur_val._fields[field].from_val(v))
+
+        cur_val.set_field(k, v)
 
     def validate(self, value):
         if not isinstance(value, self.document):
@@ -586,19 +596,70 @@ class ReferenceField(BaseField, Reference):
         if instance is None:
             return self
 
-        value = instance._data.get(self.name)
+        value = self._load(instance)
 
         if not isinstance(value, Document):
             if value is not None:
-                q = self.document_cls.objects.filter_by(id=value)
+                session = current_session()
+                document = session.get(self.document_cls, value) if session is not None else None
 
-                if self._lazyload_only:
-                    q = q.only(*self._lazyload_only)
+                if document is None:
+                    siblings = instance._siblings.documents if instance._siblings is not None else []
 
-                instance._data[self.name] = q.one()
+                    if len(siblings) > 1:
+                        self._load_siblings(siblings)
+                        document = instance._data[self.name]
+                    elif self._lazyload_only:
+                        document = self.document_cls.objects.filter_by(id=value).only(*self._lazyload_only).one()
+                    else:
+                        document = self.document_cls.objects.with_id(value)
+
+                instance._data[self.name] = document
 
         return BaseField.__get__(self, instance, owner)
 
+    def _load_siblings(self, documents):
+        values = []
+
+        for document in documents:
+            value = self._load(document)
+
+            if value is not None and not isinstance(value, Document):
+                values.append((document, value))
+
+        loaded = self._dereference_many([value for _, value in values])
+
+        for document, value in values:
+            document._data[self.name] = loaded.get(self.to_mongo(value))
+
+    def _dereference_many(self, object_ids):
+        """Loads the documents referenced by a list of ids, returning them keyed by their mongo id."""
+        document_cls = self.document_cls
+        id_field = document_cls._fields['id']
+        session = current_session()
+        documents = {}
+        missing = []
+
+        for object_id in object_ids:
+            key = id_field.to_mongo(object_id)
+
+            if key not in documents:
+                documents[key] = session.get(document_cls, object_id) if session is not None else None
+
+                if documents[key] is None:
+                    missing.append(object_id)
+
+        for i in xrange(0, len(missing), DEREFERENCE_BATCH_SIZE):
+            query = document_cls.objects
+
+            if self._lazyload_only:
+                query = query.only(*self._lazyload_only)
+
+            for object_id, document in query.in_bulk(missing[i:i + DEREFERENCE_BATCH_SIZE]).iteritems():
+                documents[id_field.to_mongo(object_id)] = document
+
+        return documents
+
     def to_mongo(self, document):
         field = self.document_cls._fields['id']
 
@@ -625,15 +686,22 @@ class ReferenceField(BaseField, Reference):
             return {}
         return delta
 
+    def canonical(self, value):
+        if isinstance(value, Document):
+            return freeze(value.to_json())
+
+        return freeze(value)
+
     def validate(self, value):
         if isinstance(value, Document):
             assert isinstance(value, self.document_cls)
 
     def add_to_document(self, cls):
         name = self.name
+        field = self
 
         def proxy(self):
-            value = self._data.get(name)
+            value = field._load(self)
 
             if isinstance(value, Document):
                 value = value.id
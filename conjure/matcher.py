@@ -0,0 +1,216 @@
+from bson.objectid import ObjectId
+from bson.binary import Binary
+from bson.int64 import Int64
+import datetime
+import math
+import re
+
+__all__ = ['compile_predicate']
+
+_NUMBER_TYPES = (int, long, float)
+_PATTERN_TYPE = type(re.compile(''))
+
+_BSON_TYPES = {
+    1: lambda v: isinstance(v, float),
+    2: lambda v: isinstance(v, basestring),
+    3: lambda v: isinstance(v, dict),
+    4: lambda v: isinstance(v, list),
+    5: lambda v: isinstance(v, Binary),
+    7: lambda v: isinstance(v, ObjectId),
+    8: lambda v: isinstance(v, bool),
+    9: lambda v: isinstance(v, datetime.datetime),
+    10: lambda v: v is None,
+    11: lambda v: isinstance(v, _PATTERN_TYPE),
+    16: lambda v: isinstance(v, int) and not isinstance(v, bool) and -2 ** 31 <= v < 2 ** 31,
+    18: lambda v: isinstance(v, (long, Int64)) or (isinstance(v, int) and not isinstance(v, bool) and
+                                                    not -2 ** 31 <= v < 2 ** 31),
+}
+
+
+def _is_number(value):
+    return isinstance(value, _NUMBER_TYPES) and not isinstance(value, bool)
+
+
+def _comparable(a, b):
+    if _is_number(a) and _is_number(b):
+        return True
+
+    return type(a) is type(b) or (isinstance(a, basestring) and isinstance(b, basestring))
+
+
+def _equal(a, b):
+    if isinstance(a, bool) != isinstance(b, bool):
+        return False
+
+    return a == b
+
+
+def _is_operators(value):
+    return isinstance(value, dict) and bool(value) and all(k.startswith('$') for k in value)
+
+
+def _resolve(document, parts):
+    values = [document]
+
+    for part in parts:
+        found = []
+
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+
+                for item in value:
+                    if isinstance(item, dict) and part in item:
+                        found.append(item[part])
+
+        values = found
+
+    return values
+
+
+def _expand(values):
+    for value in values:
+        yield value
+
+        if isinstance(value, list):
+            for item in value:
+                yield item
+
+
+def _compile_equality(target):
+    if isinstance(target, _PATTERN_TYPE):
+        return lambda values: any(isinstance(v, basestring) and target.search(v) is not None for v in _expand(values))
+
+    if target is None:
+        return lambda values: not values or any(v is None for v in _expand(values))
+
+    return lambda values: any(_equal(v, target) for v in _expand(values))
+
+
+def _compile_comparison(target, compare):
+    return lambda values: any(_comparable(v, target) and compare(v, target) for v in _expand(values))
+
+
+def _compile_in(targets):
+    tests = [_compile_equality(target) for target in targets]
+    return lambda values: any(test(values) for test in tests)
+
+
+def _compile_not(test):
+    return lambda values: not test(values)
+
+
+def _compile_all(targets):
+    tests = [_compile_equality(target) for target in targets]
+    return lambda values: bool(tests) and all(test(values) for test in tests)
+
+
+def _compile_size(size):
+    return lambda values: any(isinstance(v, list) and len(v) == size for v in values)
+
+
+def _compile_exists(exists):
+    exists = bool(exists)
+    return lambda values: bool(values) == exists
+
+
+def _compile_type(code):
+    check = _BSON_TYPES.get(code)
+
+    if check is None:
+        raise NotImplementedError('$type %r cannot be evaluated in memory' % code)
+
+    if code == 4:
+        return lambda values: any(check(v) for v in values)
+
+    return lambda values: any(check(v) for v in _expand(values))
+
+
+def _compile_mod(divisor_remainder):
+    divisor, remainder = divisor_remainder
+    return lambda values: any(_is_number(v) and int(math.fmod(v, divisor)) == remainder for v in _expand(values))
+
+
+def _compile_elem_match(spec):
+    if _is_operators(spec):
+        test = _compile_operators(spec)
+        match = lambda item: test([item])
+    else:
+        match = compile_predicate(spec)
+
+    return lambda values: any(isinstance(v, list) and any(match(item) for item in v) for v in values)
+
+
+_OPERATORS = {
+    '$ne': lambda target: _compile_not(_compile_equality(target)),
+    '$lt': lambda target: _compile_comparison(target, lambda a, b: a < b),
+    '$lte': lambda target: _compile_comparison(target, lambda a, b: a <= b),
+    '$gt': lambda target: _compile_comparison(target, lambda a, b: a > b),
+    '$gte': lambda target: _compile_comparison(target, lambda a, b: a >= b),
+    '$in': _compile_in,
+    '$nin': lambda targets: _compile_not(_compile_in(targets)),
+    '$all': _compile_all,
+    '$size': _compile_size,
+    '$exists': _compile_exists,
+    '$type': _compile_type,
+    '$mod': _compile_mod,
+    '$elemMatch': _compile_elem_match,
+}
+
+
+def _compile_operators(operators):
+    tests = []
+
+    for op, target in operators.iteritems():
+        if op == '$not':
+            if _is_operators(target):
+                tests.append(_compile_not(_compile_operators(target)))
+            else:
+                tests.append(_compile_not(_compile_equality(target)))
+        elif op in _OPERATORS:
+            tests.append(_OPERATORS[op](target))
+        else:
+            raise NotImplementedError('%s cannot be evaluated in memory' % op)
+
+    return lambda values: all(test(values) for test in tests)
+
+
+def _compile_field(path, condition):
+    parts = path.split('.')
+
+    if _is_operators(condition):
+        test = _compile_operators(condition)
+    else:
+        test = _compile_equality(condition)
+
+    return lambda document: test(_resolve(document, parts))
+
+
+def _compile_clauses(key, clauses):
+    predicates = [compile_predicate(clause) for clause in clauses]
+
+    if key == '$or':
+        return lambda document: any(predicate(document) for predicate in predicates)
+    elif key == '$and':
+        return lambda document: all(predicate(document) for predicate in predicates)
+
+    return lambda document: not any(predicate(document) for predicate in predicates)
+
+
+def compile_predicate(spec):
+    """Compiles a Mongo query dict into a function telling whether a document (as a dict) matches it."""
+    tests = []
+
+    for key, condition in spec.iteritems():
+        if key in ('$or', '$and', '$nor'):
+            tests.append(_compile_clauses(key, condition))
+        elif key.startswith('$'):
+            raise NotImplementedError('%s cannot be evaluated in memory' % key)
+        else:
+            tests.append(_compile_field(key, condition))
+
+    return lambda document: all(test(document) for test in tests)
@@ -1,5 +1,5 @@
 from .spec import Equal, NotEqual, LessThan, LessThanEqual, GreaterThan, GreaterThanEqual, In, NotIn, \
-    Exists, Type, Where, UpdateSpecification, Mod, All, Size, Slice, QuerySpecification, Match
+    Exists, Type, Where, UpdateSpecification, Mod, All, Size, Slice, QuerySpecification, Match, Param
 import types
 import re
 
@@ -219,30 +219,36 @@ class List(_Base):
 
 
 class Reference(Common):
+    def _query_value(self, value):
+        if isinstance(value, Param):
+            return value.converted(self.to_mongo)
+
+        return self.to_mongo(value)
+
     def eq(self, other):
-        return Common.eq(self, self.to_mongo(other))
+        return Common.eq(self, self._query_value(other))
 
     def ne(self, other):
-        return Common.ne(self, self.to_mongo(other))
+        return Common.ne(self, self._query_value(other))
 
     def lt(self, other):
-        return Common.lt(self, self.to_mongo(other))
+        return Common.lt(self, self._query_value(other))
 
     def lte(self, other):
-        return Common.lte(self, self.to_mongo(other))
+        return Common.lte(self, self._query_value(other))
 
     def gt(self, other):
-        return Common.gt(self, self.to_mongo(other))
+        return Common.gt(self, self._query_value(other))
 
     def gte(self, other):
-        return Common.gte(self, self.to_mongo(other))
+        return Common.gte(self, self._query_value(other))
 
     def in_(self, vals):
-        vals = [self.to_mongo(val) for val in vals]
+        vals = self._query_value(vals) if isinstance(vals, Param) else [self._query_value(val) for val in vals]
         return Common.in_(self, vals)
 
     def nin(self, vals):
-        vals = [self.to_mongo(val) for val in vals]
+        vals = self._query_value(vals) if isinstance(vals, Param) else [self._query_value(val) for val in vals]
         return Common.nin(self, vals)
 
     def set(self, val):
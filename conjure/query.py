@@ -1,14 +1,92 @@
 from .connection import connect
-from .spec import QuerySpecification, Slice
+from .spec import QuerySpecification, Slice, Param
 from .exceptions import DoesNotExist, OperationError
-from .eagerload import Eagerload
+from .eagerload import EagerloadPlan, SiblingLoader
+from .session import current_session
 from .utils import lookup_field
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 import copy
+import json
 import pymongo
 import pymongo.errors
 import pprint
 import re
 
+RAW_BSON_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+# Documents per SiblingLoader and eagerload window when the query has no batch size set.
+DEFAULT_BATCH_SIZE = 100
+
+# Operators whose list value can come from a single parameter.
+LIST_OPERATORS = ('$in', '$nin', '$all')
+
+
+def _compile_list_binder(value):
+    # in_(Param('ids')) and in_([Param('ids')]) take their whole list from the parameter.
+    if isinstance(value, list) and len(value) == 1 and isinstance(value[0], Param):
+        value = value[0]
+
+    if isinstance(value, Param):
+        name, to_mongo = value.name, value.to_mongo
+
+        def bind(params):
+            bound = params[name]
+            bound = list(bound) if isinstance(bound, (list, tuple)) else [bound]
+            return bound if to_mongo is None else map(to_mongo, bound)
+
+        return bind
+
+    return _compile_binder(value)
+
+
+def _compile_binder(value):
+    if isinstance(value, Param):
+        name, to_mongo = value.name, value.to_mongo
+
+        if to_mongo is None:
+            return lambda params: params[name]
+
+        return lambda params: to_mongo(params[name])
+
+    if isinstance(value, dict):
+        binders = [(k, _compile_list_binder(v) if k in LIST_OPERATORS else _compile_binder(v))
+                   for k, v in value.iteritems()]
+        binders = [(k, binder) for k, binder in binders if binder is not None]
+
+        if not binders:
+            return None
+
+        static = dict(value)
+
+        for k, _ in binders:
+            del static[k]
+
+        def bind(params):
+            d = static.copy()
+
+            for k, binder in binders:
+                d[k] = binder(params)
+
+            return d
+
+        return bind
+
+    if isinstance(value, list):
+        binders = [_compile_binder(v) for v in value]
+
+        if not any(binders):
+            return None
+
+        items = [(v, binder) for v, binder in zip(value, binders)]
+
+        def bind(params):
+            return [v if binder is None else binder(params) for v, binder in items]
+
+        return bind
+
+    return None
+
 
 class Manager(object):
     def __init__(self):
@@ -34,16 +112,33 @@ class Query(object):
         self._fields = None
         self._eagerloads = []
         self._deferred_sort = []
+        self._lazy = None
+        self._raw_bson = False
+        self._bound_spec = None
+        self._sort_keys = []
+        self._batch_size = None
+        self._sibling_loader = None
 
     def clone(self):
         q = Query(self._document_cls, self._collection)
         q._spec = self._spec.clone()
-        q._fields = copy.deepcopy(self._fields)
+        q._fields = dict(self._fields) if self._fields is not None else None
         q._eagerloads = copy.deepcopy(self._eagerloads)
-        q._deferred_sort = copy.deepcopy(self._deferred_sort)
+        q._deferred_sort = list(self._deferred_sort)
+        q._lazy = self._lazy
+        q._raw_bson = self._raw_bson
+        q._bound_spec = self._bound_spec
+        q._sort_keys = self._sort_keys
+        q._batch_size = self._batch_size
         return q
 
     def _compile_spec(self):
+        if self._bound_spec is not None:
+            if not self._spec.expressions:
+                return self._bound_spec
+
+            return {'$and': [self._bound_spec, self._spec.compile()]}
+
         spec = self._spec.compile()
 
         if self._document_cls._superclasses:
@@ -51,6 +146,13 @@ class Query(object):
 
         return spec
 
+    def _filtered(self):
+        return bool(self._spec.expressions) or self._bound_spec is not None
+
+    def prepare(self):
+        """Compiles this query's spec, sort and projection once for repeated execution."""
+        return PreparedQuery(self)
+
     def _transform_key_list(self, keys):
         transformed_keys = []
 
@@ -69,20 +171,54 @@ class Query(object):
 
         return transformed_keys
 
+    def _to_python(self, data):
+        session = current_session()
+
+        if session is None:
+            return self._document_cls.to_python(data, self._lazy)
+
+        if data is not None and '_id' in data:
+            document = session.get(self._document_cls, data['_id'])
+
+            if document is not None:
+                return document
+
+        document = self._document_cls.to_python(data, self._lazy)
+
+        if document is not None and self._fields is None:
+            document = session.add(document)
+
+        return document
+
+    def lazy(self, lazy=True):
+        self._lazy = lazy
+        return self
+
+    def batch_size(self, batch_size):
+        """Sets the number of documents per cursor batch, references and eagerloads are loaded a batch at a time."""
+        self._batch_size = batch_size
+        return self
+
+    def raw_bson(self, raw_bson=True):
+        self._raw_bson = raw_bson
+        return self
+
+    @property
+    def _read_collection(self):
+        if self._raw_bson:
+            return self._collection.with_options(codec_options=RAW_BSON_OPTIONS)
+
+        return self._collection
+
     def eagerload(self, *fields, **kwargs):
-        eagerload = Eagerload(kwargs.get('only'))
-        map(eagerload.add_field, fields)
-        self._eagerloads.append(eagerload)
+        """Loads the given references of the results in bulk."""
+        self._eagerloads.append(EagerloadPlan(self._document_cls, fields, kwargs.get('only')))
         return self
 
     def _eagerload(self, obj):
         if obj:
             for eagerload in self._eagerloads:
-                eagerload.add_documents(obj)
-                eagerload.flush()
-                
-            if self._document_cls._meta['track_changes']:
-                obj._base = copy.deepcopy(obj)
+                eagerload.load(obj)
 
         return obj
 
@@ -133,10 +269,10 @@ class Query(object):
         return self
 
     def one(self):
-        return self._eagerload(self._document_cls.to_python(self._one()))
+        return self._eagerload(self._to_python(self._one()))
 
     def _one(self):
-        return self._collection.find_one(self._compile_spec(), projection=self._fields)
+        return self._read_collection.find_one(self._compile_spec(), projection=self._fields)
 
     def first(self, *expressions):
         try:
@@ -147,25 +283,90 @@ class Query(object):
     def all(self):
         return [doc for doc in self]
 
+    @property
+    def _cache(self):
+        if self._filtered() or self._fields is not None:
+            return None
+
+        return self._document_cls._meta.get('cache')
+
     def with_id(self, object_id):
-        return self.filter_by(id=self._document_cls.id.to_mongo(object_id)).one()
+        object_id = self._document_cls.id.to_mongo(object_id)
+        session = current_session()
+
+        if session is not None and not self._filtered():
+            document = session.get(self._document_cls, object_id)
+
+            if document is not None:
+                return document
+
+        cache = self._cache
+
+        if cache is None:
+            return self.filter_by(id=object_id).one()
+
+        key = cache.key(self._document_cls, object_id)
+        value = cache.get(key)
+
+        if value is not None:
+            data = cache.decode(value)
+        else:
+            data = self.filter_by(id=object_id)._one()
+
+            if data is not None:
+                cache.set(key, cache.encode(data))
+
+        return self._eagerload(self._to_python(data))
 
     def in_bulk(self, object_ids):
         field = self._document_cls.id
-        return  dict([(doc.id, doc) for doc in self.filter(field.in_(map(field.to_mongo, object_ids)))])
+        object_ids = map(field.to_mongo, object_ids)
+        cache = self._cache
+
+        if cache is None:
+            return dict([(doc.id, doc) for doc in self.filter(field.in_(object_ids))])
+
+        keys = dict((object_id, cache.key(self._document_cls, object_id)) for object_id in object_ids)
+        values = cache.get_many(keys.values())
+        documents = []
+        missing = []
+
+        for object_id, key in keys.iteritems():
+            if key in values:
+                documents.append(self._to_python(cache.decode(values[key])))
+            else:
+                missing.append(object_id)
+
+        if missing:
+            for data in self.filter(field.in_(missing))._cursor:
+                cache.set(keys[data['_id']], cache.encode(data))
+                documents.append(self._to_python(data))
+
+        documents = self._eagerload([document for document in documents if document])
+
+        return dict([(doc.id, doc) for doc in documents])
 
     def next(self):
         try:
-            obj = self._document_cls.to_python(self._cursor.next())
+            obj = self._to_python(self._cursor.next())
 
             if not obj:
                 return self.next()
 
+            self._add_sibling(obj)
             return obj
         except StopIteration, e:
             self.rewind()
             raise e
 
+    def _add_sibling(self, document):
+        loader = self._sibling_loader
+
+        if loader is None or len(loader) >= (self._batch_size or DEFAULT_BATCH_SIZE):
+            loader = self._sibling_loader = SiblingLoader()
+
+        loader.add(document)
+
     def rewind(self):
         self._cursor.rewind()
         return self
@@ -189,7 +390,7 @@ class Query(object):
             self._pymongo_cursor = self._cursor[key]
             return self
         elif isinstance(key, int):
-            return self._eagerload(self._document_cls.to_python(self._cursor[key]))
+            return self._eagerload(self._to_python(self._cursor[key]))
 
     def only(self, *exprs):
         self._fields = {'_cls': 1}
@@ -245,24 +446,82 @@ class Query(object):
     def group(self, key, initial, reduce, finalize=None):
         return self._collection.group(key, self._compile_spec(), initial, reduce, finalize)
 
-    def __iter__(self):
-        if self._eagerloads:
+    def iter_json(self, only=None, external=False, batch_size=100):
+        """Yields the results as an encoded JSON array, one chunk per batch of documents."""
+        encode = json.JSONEncoder(separators=(',', ':')).encode
+        cursor = self._cursor.batch_size(batch_size)
+        prefix = '['
+
+        while True:
             documents = []
 
-            for obj in self._cursor:
-                document = self._document_cls.to_python(obj)
+            for obj in cursor:
+                document = self._to_python(obj)
 
                 if document:
                     documents.append(document)
 
-            return self._eagerload(documents).__iter__()
+                    if len(documents) == batch_size:
+                        break
+
+            if not documents:
+                break
+
+            self._eagerload(documents)
+            yield prefix + ','.join(encode(document.to_json(only=only, external=external)) for document in documents)
+            prefix = ','
+
+        yield '[]' if prefix == '[' else ']'
+
+    def __iter__(self):
+        if self._eagerloads:
+            return self._iter_windows()
 
         return self
 
+    def _iter_windows(self):
+        # Each cursor batch is hydrated, eagerloaded and yielded before the next one is fetched.
+        window_size = self._batch_size or DEFAULT_BATCH_SIZE
+        window = []
+
+        for obj in self._cursor:
+            document = self._to_python(obj)
+
+            if document:
+                window.append(document)
+
+                if len(window) == window_size:
+                    for document in self._load_window(window):
+                        yield document
+
+                    window = []
+
+        for document in self._load_window(window):
+            yield document
+
+    def _load_window(self, documents):
+        if documents:
+            siblings = SiblingLoader()
+
+            for document in documents:
+                siblings.add(document)
+
+            self._eagerload(documents)
+
+        return documents
+
     @property
     def _cursor(self):
         if self._pymongo_cursor is None:
-            self._pymongo_cursor = self._collection.find(self._compile_spec(), projection=self._fields)
+            self._pymongo_cursor = self._read_collection.find(self._compile_spec(), projection=self._fields)
+
+            for sort_keys in self._sort_keys:
+                self._pymongo_cursor.sort(sort_keys)
+
+            if self._batch_size:
+                self._pymongo_cursor.batch_size(self._batch_size)
+            elif self._eagerloads:
+                self._pymongo_cursor.batch_size(DEFAULT_BATCH_SIZE)
 
             for key_list in self._deferred_sort:
                 self.sort(key_list)
@@ -277,3 +536,33 @@ class Query(object):
             return self._document_cls._search_index.search(*args, **kwargs)
 
         raise AttributeError()
+
+
+class PreparedQuery(object):
+    def __init__(self, query):
+        spec = query._compile_spec()
+
+        self._document_cls = query._document_cls
+        self._collection = query._collection
+        self._spec = spec
+        self._bind = _compile_binder(spec)
+        self._sort_keys = query._sort_keys + [query._transform_key_list(key_list) for key_list in query._deferred_sort]
+        self._fields = query._fields
+        self._eagerloads = query._eagerloads
+        self._lazy = query._lazy
+        self._raw_bson = query._raw_bson
+        self._batch_size = query._batch_size
+
+    def __call__(self, **params):
+        q = Query(self._document_cls, self._collection)
+        q._bound_spec = self._spec if self._bind is None else self._bind(params)
+        q._sort_keys = self._sort_keys
+        q._fields = self._fields
+        q._lazy = self._lazy
+        q._raw_bson = self._raw_bson
+        q._batch_size = self._batch_size
+
+        if self._eagerloads:
+            q._eagerloads = copy.deepcopy(self._eagerloads)
+
+        return q
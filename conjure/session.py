@@ -0,0 +1,209 @@
+from .exceptions import OperationError, BulkOperationError
+import threading
+import pymongo.errors
+import bson
+
+__all__ = ['Session', 'UnitOfWork']
+
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+_local = threading.local()
+
+
+def _current(name):
+    stack = getattr(_local, name, None)
+
+    if stack:
+        return stack[-1]
+
+    return None
+
+
+def _push(name, value):
+    stack = getattr(_local, name, None)
+
+    if stack is None:
+        stack = []
+        setattr(_local, name, stack)
+
+    stack.append(value)
+
+
+def _pop(name, value):
+    getattr(_local, name).remove(value)
+
+
+def _bulk_write_failures(err):
+    failed = dict((error['index'], error['errmsg']) for error in err.details.get('writeErrors', []))
+
+    if not failed:
+        raise OperationError(unicode(err))
+
+    return failed
+
+
+def current_session():
+    return _current('sessions')
+
+
+def current_unit_of_work():
+    return _current('units_of_work')
+
+
+class Session(object):
+    """Identity map for the documents loaded while it is active."""
+
+    def __init__(self):
+        self._documents = {}
+
+    def __enter__(self):
+        _push('sessions', self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _pop('sessions', self)
+
+    @staticmethod
+    def _key(document_cls, object_id):
+        return document_cls._meta['db'], document_cls._meta['collection'], object_id
+
+    def get(self, document_cls, object_id):
+        document = self._documents.get(self._key(document_cls, object_id))
+
+        if isinstance(document, document_cls):
+            return document
+
+        return None
+
+    def add(self, document):
+        if document.id is None:
+            return document
+
+        return self._documents.setdefault(self._key(document.__class__, document.id), document)
+
+    def remove(self, document):
+        self._documents.pop(self._key(document.__class__, document.id), None)
+
+    def clear(self):
+        self._documents.clear()
+
+
+class UnitOfWork(object):
+    """Queues the Document.save() and Document.delete() calls made while it is active."""
+
+    def __init__(self, ordered=True, batch_size=None):
+        self.ordered = ordered
+        self.batch_size = batch_size
+        self._queue = []
+        self._saves = set()
+
+    def __enter__(self):
+        _push('units_of_work', self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _pop('units_of_work', self)
+
+        if exc_type is None:
+            self.flush()
+        else:
+            self.clear()
+
+    def save(self, document, insert=False):
+        if id(document) not in self._saves:
+            self._saves.add(id(document))
+            self._queue.append((document, insert, False))
+
+    def delete(self, document):
+        if id(document) in self._saves:
+            # Unordered writes may run in any order, a queued save could otherwise bring the document back.
+            self._saves.discard(id(document))
+            self._queue = [entry for entry in self._queue if entry[0] is not document or entry[2]]
+
+        self._queue.append((document, False, True))
+
+    def clear(self):
+        del self._queue[:]
+        self._saves.clear()
+
+    def flush(self):
+        queue = self._queue
+        self._queue = []
+        self._saves.clear()
+
+        groups = []
+        errors = []
+
+        for document, insert, delete in queue:
+            collection = document.__class__.objects._collection
+
+            if delete:
+                request = document._delete_request()
+            else:
+                request = document._write_request(insert)
+
+            if request[0] is None:
+                request[2]()
+                continue
+
+            if self.ordered:
+                if not groups or groups[-1][0] is not collection:
+                    groups.append((collection, []))
+
+                groups[-1][1].append((document, request))
+            else:
+                for group in groups:
+                    if group[0] is collection:
+                        group[1].append((document, request))
+                        break
+                else:
+                    groups.append((collection, [(document, request)]))
+
+        for collection, requests in groups:
+            for chunk in self._chunks(collection, requests):
+                if not self._write(collection, chunk, errors) and self.ordered:
+                    raise BulkOperationError(errors)
+
+        if errors:
+            raise BulkOperationError(errors)
+
+    def _chunks(self, collection, requests):
+        batch_size = self.batch_size or collection.database.client.max_write_batch_size
+        chunk = []
+        size = 0
+
+        for document, request in requests:
+            request_size = len(bson.BSON.encode(request[1])) if request[1] is not None else 0
+
+            if chunk and (len(chunk) == batch_size or size + request_size > MAX_BATCH_BYTES):
+                yield chunk
+                chunk = []
+                size = 0
+
+            chunk.append((document, request))
+            size += request_size
+
+        if chunk:
+            yield chunk
+
+    def _write(self, collection, chunk, errors):
+        try:
+            collection.bulk_write([request[0] for _, request in chunk], ordered=self.ordered)
+        except pymongo.errors.BulkWriteError, err:
+            failed = _bulk_write_failures(err)
+            first_failure = min(failed)
+
+            for i, (document, request) in enumerate(chunk):
+                if i in failed:
+                    errors.append((document, OperationError(failed[i])))
+                elif not self.ordered or i < first_failure:
+                    request[2]()
+
+            return False
+        except pymongo.errors.OperationFailure, err:
+            raise OperationError(unicode(err))
+
+        for document, request in chunk:
+            request[2]()
+
+        return True
@@ -1,12 +1,119 @@
+from .matcher import compile_predicate
+from .updater import apply_update
+from bson.raw_bson import RawBSONDocument
 import copy
 import types
 import collections
+import datetime
 import re
-try: import cPickle as pickle
-except ImportException: import pickle
+import bson
+
+# Query expressions are keyed by the field path they apply to ('' for top level operators) and their operators.
+Key = collections.namedtuple('Key', ['path', 'ops'])
+
+OR = Key('', ('or',))
+
+_NUMBER_TYPES = (int, long, float)
+_PATTERN_TYPE = type(re.compile(''))
+
+
+def _comparable(a, b):
+    if isinstance(a, _NUMBER_TYPES) and isinstance(b, _NUMBER_TYPES):
+        return not isinstance(a, bool) and not isinstance(b, bool)
+
+    return type(a) is type(b) and isinstance(a, (basestring, datetime.datetime))
+
+
+def _tighten(ops, strict, inclusive, tighter):
+    if strict in ops and inclusive in ops and _comparable(ops[strict], ops[inclusive]):
+        if tighter(ops[inclusive], ops[strict]):
+            del ops[strict]
+        else:
+            del ops[inclusive]
+
+
+def _is_operators(value):
+    return isinstance(value, dict) and bool(value) and all(k.startswith('$') for k in value)
+
+
+def _optimize_operators(ops, field=True):
+    ops = dict(ops)
+
+    if '$not' in ops:
+        value = ops['$not']
+
+        if isinstance(value, dict):
+            if value.keys() == ['$in'] and '$nin' not in ops:
+                ops['$nin'] = ops.pop('$not')['$in']
+            elif value.keys() == ['$nin'] and '$in' not in ops:
+                ops['$in'] = ops.pop('$not')['$nin']
+        elif not isinstance(value, _PATTERN_TYPE) and '$ne' not in ops:
+            ops['$ne'] = ops.pop('$not')
+
+    _tighten(ops, '$gt', '$gte', lambda a, b: a > b)
+    _tighten(ops, '$lt', '$lte', lambda a, b: a < b)
+
+    if isinstance(ops.get('$elemMatch'), dict):
+        value = ops['$elemMatch']
+        ops['$elemMatch'] = _optimize_operators(value, field=False) if _is_operators(value) else optimize(value)
+
+    # Only a field condition can be a plain value, operators applied to array elements have to stay operators.
+    if field and len(ops) == 1:
+        op, value = ops.items()[0]
+
+        # A parameter may be bound to a list, which as a plain value would match the whole array instead.
+        if op in ('$in', '$nin') and isinstance(value, (list, tuple)) and len(value) == 1 \
+                and not isinstance(value[0], (dict, Param)):
+            return value[0] if op == '$in' else {'$ne': value[0]}
+
+    return ops
+
+
+def optimize(spec):
+    """Returns a simplified copy of a compiled query spec that matches the same documents."""
+    optimized = {}
+
+    for key, value in spec.iteritems():
+        if key in ('$or', '$and') and isinstance(value, list):
+            clauses = []
+
+            for clause in value:
+                if isinstance(clause, dict):
+                    clause = optimize(clause)
+
+                    if clause.keys() == [key]:
+                        clauses.extend(clause[key])
+                        continue
+
+                clauses.append(clause)
+
+            optimized[key] = clauses
+        elif _is_operators(value):
+            optimized[key] = _optimize_operators(value)
+        else:
+            optimized[key] = value
+
+    return optimized
+
+
+class Param(object):
+    """Placeholder for a value supplied when a prepared query is executed."""
+
+    def __init__(self, name, to_mongo=None):
+        self.name = name
+        self.to_mongo = to_mongo
+
+    def converted(self, to_mongo):
+        """Returns this placeholder with its bound values converted by to_mongo."""
+        return Param(self.name, to_mongo)
+
+    def __repr__(self):
+        return 'Param(%r)' % self.name
 
 
 class Specification(object):
+    _predicate = None
+
     def compile(self, **kwargs):
         raise NotImplemented
 
@@ -23,7 +130,11 @@ class Specification(object):
         raise NotImplemented
 
     def clone(self):
-        return copy.deepcopy(self)
+        # Values are never mutated once they are part of a specification, so clones share them.
+        spec = copy.copy(self)
+        spec.expressions = dict(self.expressions)
+        spec._predicate = None
+        return spec
 
     def _set_expression(self, k, ops, v):
         raise NotImplemented
@@ -47,9 +158,11 @@ class Specification(object):
         return self.expressions.__getitem__(k)
 
     def __setitem__(self, k, v):
+        self._predicate = None
         return self.expressions.__setitem__(k, v)
 
     def __delitem__(self, k):
+        self._predicate = None
         return self.expressions.__delitem__(k)
 
     def is_update(self):
@@ -75,33 +188,45 @@ class UpdateSpecification(Specification):
     def empty(self):
         return not self.expressions
 
+    def apply(self, target, query=None):
+        """Applies the update in place to a document or a mongo dict, the way the server would."""
+        if isinstance(query, QuerySpecification):
+            query = query.compile()
+
+        if isinstance(target, dict):
+            apply_update(target, self.compile(), query)
+        else:
+            target._apply_update(self.compile(), query)
+
+        return target
+
     def __and__(self, other):
         spec = self.clone()
 
         for key in other:
             if key in spec:
                 if key.startswith('pushAll:') or key.startswith('pullAll:'):
-                    spec[key].extend(copy.deepcopy(other[key]))
+                    spec[key] = spec[key] + other[key]
                     continue
                 elif key.startswith('inc:'):
                     spec[key] += other[key]
                     continue
 
-            spec[key] = copy.deepcopy(other[key])
+            spec[key] = other[key]
 
-        return UpdateSpecification(spec)
+        return UpdateSpecification(spec.expressions)
 
 
 class QuerySpecification(Specification):
-    def compile(self, prefix=''):
+    def compile(self, prefix='', optimized=True):
         d = {}
 
-        for expr in self:
-            key, ops = self._parse_expression(expr)
-            val = self[expr]
+        if prefix:
+            prefix += '.'
 
-            if prefix:
-                key = re.sub(r'^' + prefix + r'\.', '', key)
+        for (key, ops), val in self.expressions.iteritems():
+            if prefix and key.startswith(prefix):
+                key = key[len(prefix):]
 
             if not key:
                 key = '$' + ops[0]
@@ -125,62 +250,60 @@ class QuerySpecification(Specification):
 
             path[-2][last_key] = val
 
+        if optimized:
+            return optimize(d)
+
         return d
 
-    def _set_expression(self, k, ops, v):
-        self.expressions[k + ':' + ':'.join(ops.split())] = v
+    def debug(self):
+        """Returns the compiled spec before and after optimization."""
+        return {'original': self.compile(optimized=False), 'optimized': self.compile()}
 
-    def _parse_expression(self, expr):
-        if expr.startswith(':'):
-            key, ops = '', expr[1:]
-        elif expr.endswith(':'):
-            key, ops = expr[:-1], ''
-        else:
-            key, _, ops = expr.partition(':')
+    def predicate(self):
+        """Returns a function telling whether a mongo dict matches this spec, compiled once per spec."""
+        if self._predicate is None:
+            self._predicate = compile_predicate(self.compile())
 
-        ops = ops.split(':')
+        return self._predicate
 
-        try:
-            ops.remove('')
-        except ValueError:
-            pass
+    def matches(self, document):
+        if isinstance(document, RawBSONDocument):
+            document = bson.BSON(document.raw).decode()
+        elif hasattr(document, 'to_mongo'):
+            document = document.to_mongo()
 
-        return key, ops
+        return self.predicate()(document)
 
-    def _invert_op(self, op):
-        spec = self.clone()
+    def _set_expression(self, k, ops, v):
+        self.expressions[Key(k, tuple(ops.split()))] = v
 
-        for expr in self:
-            key, ops = self._parse_expression(expr)
+    def _invert_op(self, op):
+        expressions = {}
 
+        for (key, ops), val in self.expressions.iteritems():
             if op not in ops:
-                ops.insert(0, op)
+                ops = (op,) + ops
             else:
-                ops.remove(op)
-
-            spec[key + ':' + ':'.join(ops)] = spec[expr]
+                i = ops.index(op)
+                ops = ops[:i] + ops[i + 1:]
 
-            del spec[expr]
+            expressions[Key(key, ops)] = val
 
-        return spec.expressions
+        return expressions
 
     def _swap_op(self, old_op, new_op):
-        spec = self.clone()
+        expressions = {}
 
-        for expr in self:
-            key, ops = self._parse_expression(expr)
+        for (key, ops), val in self.expressions.iteritems():
+            i = ops.index(old_op)
+            expressions[Key(key, ops[:i] + (new_op,) + ops[i + 1:])] = val
 
-            ops[ops.index(old_op)] = new_op
-
-            spec[key + ':' + ':'.join(ops)] = spec[expr]
-            del spec[expr]
-
-        return spec.expressions
+        return expressions
 
     def __or__(self, other):
-        if ':or' in self.expressions:
+        if OR in self.expressions:
             spec = self.clone()
-            spec.expressions[':or'].append(other.compile())
+            spec.expressions[OR] = spec.expressions[OR] + [other.compile()]
             return spec
 
         return QuerySpecification(['', 'or', [self.compile(), other.compile()]])
@@ -191,8 +314,8 @@ class QuerySpecification(Specification):
         spec = self.clone()
 
         for expr in other:
-            if expr in spec and expr == ':or':
-                spec[expr].extend(other[expr])
+            if expr == OR and expr in spec:
+                spec[expr] = spec[expr] + other[expr]
                 continue
 
             spec[expr] = other[expr]
@@ -204,9 +327,6 @@ class QuerySpecification(Specification):
     def __invert__(self):
         return QuerySpecification(self._invert_op('not'))
 
-    def __deepcopy__(self, memo):
-        return pickle.loads(pickle.dumps(self))
-
 
 class Equal(QuerySpecification):
     def __invert__(self):
@@ -267,7 +387,8 @@ class Match(QuerySpecification):
 
         offset = len(expression[0]) + 1
 
-        for k, v in expressions.compile().iteritems():
+        # The inner spec is optimized along with the outer one, see _optimize_operators.
+        for k, v in expressions.compile(optimized=False).iteritems():
             expression[2][k[offset:]] = v
 
         QuerySpecification.__init__(self, expression)
@@ -284,7 +405,7 @@ class Exists(QuerySpecification):
         for expr in self:
             spec[expr] = not spec[expr]
 
-        return Exists(spec)
+        return Exists(spec.expressions)
 
 
 class Type(QuerySpecification):
@@ -0,0 +1,239 @@
+from .matcher import compile_predicate
+from .exceptions import InvalidQueryError
+import copy
+
+__all__ = ['apply_update']
+
+_MISSING = object()
+
+
+def _positional_index(doc, prefix, query):
+    items = _get(doc, prefix)
+
+    if query is not None and isinstance(items, list):
+        conditions = dict((k, v) for k, v in query.iteritems() if k == prefix or k.startswith(prefix + '.'))
+
+        if conditions:
+            matches = compile_predicate(conditions)
+            parts = prefix.split('.')
+
+            for i, item in enumerate(items):
+                probe = [item]
+
+                for part in reversed(parts):
+                    probe = {part: probe}
+
+                if matches(probe):
+                    return str(i)
+
+    raise InvalidQueryError('The positional operator did not find the match needed from the query')
+
+
+def _get(doc, path):
+    value = doc
+
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, _MISSING)
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+
+        if value is _MISSING:
+            return _MISSING
+
+    return value
+
+
+def _resolve(doc, path, query):
+    parts = path.split('.')
+
+    for i, part in enumerate(parts):
+        if part == '$':
+            parts[i] = _positional_index(doc, '.'.join(parts[:i]), query)
+
+    return parts
+
+
+def _container(doc, parts, create=True):
+    container = doc
+
+    for i, part in enumerate(parts[:-1]):
+        if isinstance(container, list):
+            index = int(part)
+
+            if create:
+                container.extend([None] * (index + 1 - len(container)))
+            elif index >= len(container):
+                return None
+
+            if container[index] is None and create:
+                container[index] = {}
+
+            container = container[index]
+        else:
+            if part not in container:
+                if not create:
+                    return None
+
+                container[part] = {}
+
+            container = container[part]
+
+        if not isinstance(container, (dict, list)):
+            raise InvalidQueryError('Cannot apply the update to a non-document value at %s' % '.'.join(parts[:i + 1]))
+
+    return container
+
+
+def _read(container, key, default=_MISSING):
+    if isinstance(container, list):
+        index = int(key)
+        return container[index] if index < len(container) else default
+
+    return container.get(key, default)
+
+
+def _write(container, key, value):
+    if isinstance(container, list):
+        index = int(key)
+        container.extend([None] * (index + 1 - len(container)))
+        container[index] = value
+    else:
+        container[key] = value
+
+
+def _array(container, key, create=True):
+    value = _read(container, key, None)
+
+    if value is None:
+        if not create:
+            return None
+
+        value = []
+        _write(container, key, value)
+    elif not isinstance(value, list):
+        raise InvalidQueryError('Cannot apply an array update to a non-array value at %s' % key)
+
+    return value
+
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return value['$each']
+
+    return [value]
+
+
+def _check_each(value):
+    if isinstance(value, dict) and '$each' in value:
+        for modifier in value:
+            if modifier != '$each':
+                raise InvalidQueryError('%s cannot be applied locally' % modifier)
+
+
+def _pull_matcher(condition):
+    if isinstance(condition, dict):
+        if condition and all(k.startswith('$') for k in condition):
+            matches = compile_predicate({'value': condition})
+            return lambda item: matches({'value': item})
+
+        matches = compile_predicate(condition)
+        return lambda item: isinstance(item, dict) and matches(item)
+
+    return lambda item: item == condition
+
+
+def _set(container, key, value):
+    _write(container, key, copy.deepcopy(value))
+
+
+def _unset(container, key, value):
+    if isinstance(container, list):
+        if int(key) < len(container):
+            container[int(key)] = None
+    else:
+        container.pop(key, None)
+
+
+def _inc(container, key, value):
+    _write(container, key, _read(container, key, 0) + value)
+
+
+def _push(container, key, value):
+    _array(container, key).extend(copy.deepcopy(_each(value)))
+
+
+def _push_all(container, key, value):
+    _array(container, key).extend(copy.deepcopy(value))
+
+
+def _add_to_set(container, key, value):
+    items = _array(container, key)
+
+    for item in _each(value):
+        if item not in items:
+            items.append(copy.deepcopy(item))
+
+
+def _pull(container, key, value):
+    items = _array(container, key, create=False)
+
+    if items:
+        matches = _pull_matcher(value)
+        items[:] = [item for item in items if not matches(item)]
+
+
+def _pull_all(container, key, value):
+    items = _array(container, key, create=False)
+
+    if items:
+        items[:] = [item for item in items if item not in value]
+
+
+def _pop(container, key, value):
+    items = _array(container, key, create=False)
+
+    if items:
+        items.pop(0 if value < 0 else -1)
+
+
+_OPERATORS = {
+    '$set': (_set, True),
+    '$unset': (_unset, False),
+    '$inc': (_inc, True),
+    '$push': (_push, True),
+    '$pushAll': (_push_all, True),
+    '$addToSet': (_add_to_set, True),
+    '$pull': (_pull, False),
+    '$pullAll': (_pull_all, False),
+    '$pop': (_pop, False),
+}
+
+
+def apply_update(doc, update, query=None):
+    """Applies a compiled update dict to a mongo dict in place and returns the top level keys it touched."""
+    touched = set()
+
+    # Checked before anything is applied so an update that cannot be mirrored leaves doc untouched.
+    for op, fields in update.iteritems():
+        if op not in _OPERATORS:
+            raise InvalidQueryError('%s cannot be applied locally' % op)
+
+        if op in ('$push', '$addToSet'):
+            for value in fields.itervalues():
+                _check_each(value)
+
+    for op, fields in update.iteritems():
+        apply_op, create = _OPERATORS[op]
+
+        for path, value in fields.iteritems():
+            parts = _resolve(doc, path, query)
+            container = _container(doc, parts, create)
+
+            if container is not None:
+                apply_op(container, parts[-1], value)
+                touched.add(parts[0])
+
+    return touched
@@ -1,11 +1,13 @@
 import conjure
 import unittest
 import datetime
+import time
 from conjure.documents import Document, EmbeddedDocument
 from conjure.fields import StringField, IntegerField, ReferenceField, DateTimeField, EmailField, ListField, EmbeddedDocumentField
 from conjure.exceptions import ValidationError
 from conjure.utils import Alias
 import bson
+import bson.raw_bson
 import uuid
 
 class DocumentTest(unittest.TestCase):
@@ -159,6 +161,34 @@ class DocumentTest(unittest.TestCase):
             user.set_field('this_does_not_exist', 'thing')
         self.assertRaises(KeyError, invalid_path_test)
 
+        user.set_fields({
+            'age': '40',
+            'prefs.key4': 'val4',
+            'contacts.manager': 'boss',
+            'contacts.address.street': 'Main St',
+            'favorite_foods.0': 'beef',
+            'history.0.note': 'batch note',
+            'history.1.tags.0': 'w',
+            'history.1.details.action': 'batch action'
+        })
+        self.assertEqual(user.age, 40)
+        self.assertEqual(user.prefs['key4'], 'val4')
+        self.assertEqual(user.contacts.manager, 'boss')
+        self.assertEqual(user.contacts.address.street, 'Main St')
+        self.assertEqual(user.contacts.emergency, 'hospital')
+        self.assertEqual(user.favorite_foods, ['beef', 'pasta', 'lamb'])
+        self.assertEqual(user.history[0].note, 'batch note')
+        self.assertEqual(user.history[1].tags, ['w', 'y', 'z'])
+        self.assertEqual(user.history[1].details.action, 'batch action')
+
+        user.set_fields({'history.0.note': 'nested note', 'history.0': UserHistoryItem(note='whole item')})
+        self.assertEqual(user.history[0].note, 'nested note')
+
+        user.set_field('history.1.tags.2', 'v')
+        self.assertEqual(user.history[1].tags, ['w', 'y', 'v'])
+        self.assertTrue(all('.' not in path for path in User._setters))
+        self.assertRaises(KeyError, user.set_fields, {'this_does_not_exist.key': 'thing'})
+
 
     def test_deltas(self):
         class DigitizationRequest(conjure.Document):
@@ -241,6 +271,53 @@ class DocumentTest(unittest.TestCase):
         self.assertTrue(len(deltas2['errors']['added']) == 0)
         self.assertTrue(len(deltas2['errors']['removed']) == 1)
 
+        base = datetime.datetime(2015, 1, 1)
+        cur = datetime.datetime(2015, 1, 2)
+        self.assertEqual(DateTimeField().deltas(cur, base),
+                         {'old': int(time.mktime(cur.timetuple())), 'new': int(time.mktime(base.timetuple()))})
+        self.assertEqual(DateTimeField().deltas(cur, cur), {})
+
+    def test_read_snapshots(self):
+        class Post(Document):
+            tags = ListField(StringField())
+            meta = conjure.fields.DictField()
+
+        Post.drop_collection()
+        Post(tags=['a'], meta={'k': 1}).save()
+
+        post = Post.objects.one()
+        post.tags
+        post.meta
+        self.assertFalse(isinstance(post._snapshots['tags'], str))
+        self.assertEqual(post._changes(), {})
+
+        post.tags.append('b')
+        post.meta['k'] = 2
+        self.assertEqual(sorted(post._changes()), ['meta', 'tags'])
+
+        post.save()
+        post = Post.objects.one()
+        self.assertEqual((post.tags, post.meta), (['a', 'b'], {'k': 2}))
+
+        Post.drop_collection()
+
+    def test_list_diff(self):
+        field = ListField(StringField())
+
+        self.assertEqual(field.diff(['a', 'b', 'c'], ['a', 'b', 'c']), [])
+        self.assertEqual(field.diff(['c', 'a', 'b', 'd'], ['a', 'b', 'c', 'e']), [
+            {'op': 'remove', 'index': 3, 'value': 'e'},
+            {'op': 'move', 'from': 2, 'to': 0},
+            {'op': 'insert', 'index': 3, 'value': 'd'}
+        ])
+
+        deltas = field.deltas(['a', 'x', 'c'], ['a', 'b', 'c'])
+
+        self.assertEqual(deltas['added'], ['x'])
+        self.assertEqual(deltas['removed'], ['b'])
+        self.assertEqual(deltas['1'], {'old': 'b', 'new': 'x'})
+        self.assertTrue('0' not in deltas and '2' not in deltas)
+
     def test_get_superclasses(self):
         class Animal(Document): pass
         class Fish(Animal): pass
@@ -274,6 +351,12 @@ class DocumentTest(unittest.TestCase):
             'Animal.Mammal.Human': Human
         })
 
+        self.assertEqual(Animal.to_python({'_cls': 'Animal.Bird'}), None)
+
+        class Bird(Animal): pass
+
+        self.assertTrue(isinstance(Animal.to_python({'_cls': 'Animal.Bird'}), Bird))
+
     def test_polymorphic_queries(self):
         class Animal(Document): pass
         class Fish(Animal): pass
@@ -411,6 +494,67 @@ class DocumentTest(unittest.TestCase):
         self.assertEqual(user.name, "Test User")
         self.assertEqual(user.age, 30)
 
+    def test_compiled_hydration(self):
+        class Profile(EmbeddedDocument):
+            bio = StringField()
+
+        class Member(Document):
+            name = StringField(db_field='n')
+            age = IntegerField()
+            profile = EmbeddedDocumentField(Profile)
+
+        object_id = bson.objectid.ObjectId()
+        member = Member.to_python({'_id': object_id, 'n': 'test', 'age': 30.0, 'profile': {'bio': 5}, 'junk': 1})
+
+        self.assertEqual(member.id, object_id)
+        self.assertEqual(member.name, u'test')
+        self.assertTrue(isinstance(member.age, int))
+        self.assertEqual(member.profile.bio, u'5')
+        self.assertFalse('junk' in member._data)
+
+        self.assertEqual(member.to_mongo(), {'_id': object_id, 'n': u'test', 'age': 30, 'profile': {'bio': u'5'}})
+
+    def test_raw_bson(self):
+        class Comment(EmbeddedDocument):
+            content = StringField()
+
+        class Settings(EmbeddedDocument):
+            theme = StringField()
+
+        class BlogPost(Document):
+            title = StringField()
+            comments = ListField(EmbeddedDocumentField(Comment))
+            settings = EmbeddedDocumentField(Settings)
+
+        object_id = bson.objectid.ObjectId()
+        raw = bson.BSON.encode({'_id': object_id, 'title': 'test', 'comments': [{'content': 'first'}]})
+        post = BlogPost.to_python(bson.raw_bson.RawBSONDocument(raw))
+
+        self.assertEqual(post._data, {})
+        self.assertEqual(post.title, 'test')
+        self.assertEqual(post.to_bson(), raw)
+
+        self.assertEqual(post.comments[0].content, 'first')
+        self.assertTrue(isinstance(post.comments[0], Comment))
+        self.assertEqual(post.to_bson(), raw)
+
+        post.comments[0].content = 'changed'
+        self.assertEqual(bson.BSON(post.to_bson()).decode()['comments'], [{'content': 'changed'}])
+
+        post = BlogPost.to_python(bson.raw_bson.RawBSONDocument(raw))
+        del post.title
+        self.assertFalse('title' in bson.BSON(post.to_bson()).decode())
+
+        raw = bson.BSON.encode({'_id': object_id, 'comments': [{'content': 'first'}], 'settings': {'theme': 'dark'}})
+        post = BlogPost.to_python(bson.raw_bson.RawBSONDocument(raw))
+        self.assertEqual(post.to_mongo()['settings'], {'theme': 'dark'})
+        self.assertTrue((Settings.theme == 'dark').matches(post))
+        self.assertTrue((Comment.content == 'first').matches(post))
+
+        post = BlogPost.to_python(bson.raw_bson.RawBSONDocument(raw))
+        Settings.theme.set('light').apply(post)
+        self.assertEqual(post.settings.theme, 'light')
+
     def test_reload(self):
         user = self.User(name="Test User", age=20)
         user.save()
@@ -427,6 +571,42 @@ class DocumentTest(unittest.TestCase):
         self.assertEqual(user.name, "Mr Test User")
         self.assertEqual(user.age, 21)
 
+    def test_partial_save(self):
+        class Comment(EmbeddedDocument):
+            content = StringField()
+
+        class BlogPost(Document):
+            title = StringField()
+            hits = IntegerField()
+            comments = ListField(EmbeddedDocumentField(Comment))
+
+        BlogPost.drop_collection()
+
+        post = BlogPost(title='test', hits=1, comments=[Comment(content='a'), Comment(content='b')])
+        post.save()
+
+        post_obj = BlogPost.objects.only('title').one()
+        post_obj.title = 'changed'
+        self.assertEqual(post_obj._update_spec(post_obj._changes()), {'$set': {'title': u'changed'}})
+        post_obj.save()
+
+        post.reload()
+        self.assertEqual(post.title, 'changed')
+        self.assertEqual(post.hits, 1)
+        self.assertEqual(len(post.comments), 2)
+
+        post.comments[1].content = 'c'
+        del post.hits
+        self.assertEqual(post._update_spec(post._changes()), {'$set': {'comments.1': {'content': 'c'}}, '$unset': {'hits': 1}})
+        post.save()
+        self.assertEqual(post._changes(), {})
+
+        post_son = BlogPost.objects.find_one()
+        self.assertEqual(post_son['comments'], [{'content': 'a'}, {'content': 'c'}])
+        self.assertFalse('hits' in post_son)
+
+        BlogPost.drop_collection()
+
     def test_dictionary_access(self):
         user = self.User(name='Test User', age=30)
         self.assertEquals(user['name'], 'Test User')
@@ -470,6 +650,55 @@ class DocumentTest(unittest.TestCase):
         comment.date = datetime.datetime.now()
         comment.validate()
 
+    def test_dirty_validation(self):
+        class Task(Document):
+            title = StringField(required=True)
+            status = StringField(choices=[('open', 'Open'), ('closed', 'Closed')])
+            labels = ListField(StringField(max_length=3))
+
+        Task.drop_collection()
+        Task.objects._collection.insert({'status': 'unknown'})
+
+        task = Task.objects.one()
+        self.assertRaises(ValidationError, task.validate)
+
+        task.status = 'closed'
+        task.save()
+        self.assertEqual(Task.objects.one().status, 'closed')
+
+        task.status = 'reopened'
+        self.assertRaises(ValidationError, task.save)
+
+        errors = Task.validate_many([task, Task(title='test', status='open'), Task(status='open')])
+        self.assertTrue(isinstance(errors[0], ValidationError))
+        self.assertEqual(errors[1], None)
+        self.assertTrue(isinstance(errors[2], ValidationError))
+
+        Task.objects._collection.insert({'title': 'listed', 'status': 'open', 'labels': ['too long']})
+        task = Task.objects.filter_by(title='listed').one()
+        self.assertEqual(task.labels, ['too long'])
+        task.status = 'closed'
+        task.save()
+
+        task.labels.append('ok')
+        self.assertRaises(ValidationError, task.save)
+
+    def test_apply_update(self):
+        user = self.User(name='Test User', age=30)
+        user.save()
+        user = self.User.objects.with_id(user.id)
+
+        update = self.User.age.inc(2) & self.User.name.set('Updated')
+        self.User.objects.filter_by(id=user.id).update_one(update)
+        update.apply(user)
+
+        self.assertEqual(user.age, 32)
+        self.assertEqual(user.name, 'Updated')
+        self.assertEqual(user._changes(), {})
+
+        user.age = 40
+        self.assertEqual(user._changes().keys(), ['age'])
+
     def test_save(self):
         user = self.User(name='Test User', age=30)
         user.save()
@@ -499,6 +728,28 @@ class DocumentTest(unittest.TestCase):
         user_obj = self.User.objects.find_one(self.User.name == 'Test User')
         self.assertEqual(str(user_obj['_id']), '497ce96f395f2f052a494fd4')
 
+    def test_insert_many(self):
+        self.User.drop_collection()
+
+        users = [self.User(name='User %d' % i, age=i) for i in range(25)]
+        self.User.insert_many(iter(users), batch_size=10)
+
+        self.assertEqual(self.User.objects.count(), 25)
+        self.assertTrue(all(user.id is not None for user in users))
+        self.assertEqual(self.User.objects.with_id(users[7].id).name, 'User 7')
+
+        self.assertRaises(ValidationError, self.User.insert_many, [self.User(name='Invalid', age='old')])
+        self.assertEqual(self.User.objects.count(), 25)
+
+        valid = self.User(name='Valid', age=1)
+        self.assertRaises(ValidationError, self.User.insert_many, [valid, self.User(name='Invalid', age='old')],
+                          batch_size=1)
+        self.assertEqual(self.User.objects.count(), 26)
+        self.assertEqual(self.User.objects.with_id(valid.id).name, 'Valid')
+        self.assertEqual(valid._dirty, set())
+
+        self.User.drop_collection()
+
     def test_save_list(self):
         class Comment(EmbeddedDocument):
             content = StringField()
@@ -1,6 +1,8 @@
 import unittest
 from conjure.documents import Document, EmbeddedDocument
 from conjure.fields import StringField, ReferenceField, IntegerField, EmbeddedDocumentField, ListField
+from conjure.exceptions import EagerloadException
+from conjure.session import Session
 
 class EagerloadTest(unittest.TestCase):
     def test_eagerload(self):
@@ -56,4 +58,94 @@ class EagerloadTest(unittest.TestCase):
                 self.assertEqual(type(like), User)
 
         User.drop_collection()
-        BlogPost.drop_collection()
\ No newline at end of file
+        BlogPost.drop_collection()
+
+    def test_nested_eagerload(self):
+        class Company(Document):
+            name = StringField()
+
+        class User(Document):
+            name = StringField()
+            company = ReferenceField(Company)
+
+        class Tag(Document):
+            label = StringField()
+
+        class Comment(EmbeddedDocument):
+            by = ReferenceField(User)
+
+        class BlogPost(Document):
+            author = ReferenceField(User)
+            tags = ListField(ReferenceField(Tag))
+            comments = ListField(EmbeddedDocumentField(Comment))
+
+        for cls in (Company, User, Tag, BlogPost):
+            cls.drop_collection()
+
+        company = Company(name='Company')
+        company.save()
+        users = [User(name='User #%d' % i, company=company) for i in xrange(3)]
+
+        for user in users:
+            user.save()
+
+        tag = Tag(label='python')
+        tag.save()
+
+        for i in xrange(3):
+            BlogPost(author=users[i], tags=[tag], comments=[Comment(by=users[(i + 1) % 3])]).save()
+
+        posts = list(BlogPost.objects.eagerload('comments.by.company', 'author', BlogPost.tags, only=[User.name]))
+        self.assertEqual(len(posts), 3)
+
+        for post in posts:
+            self.assertEqual(type(post._data['author']), User)
+            self.assertEqual(type(post._data['tags'][0]), Tag)
+            self.assertEqual(post._data['tags'][0].label, 'python')
+
+            by = post.comments[0]._data['by']
+            self.assertEqual(type(by), User)
+            self.assertEqual(type(by._data['company']), Company)
+            self.assertEqual(by._data['company'].name, 'Company')
+
+        with Session():
+            loaded_tag = Tag.objects.with_id(tag.id)
+            posts = list(BlogPost.objects.eagerload('author.company', 'tags'))
+            self.assertTrue(posts[0]._data['tags'][0] is loaded_tag)
+            self.assertTrue(posts[1]._data['author'] is User.objects.with_id(users[1].id))
+
+        self.assertRaises(EagerloadException, BlogPost.objects.eagerload, 'comments')
+        self.assertRaises(EagerloadException, BlogPost.objects.eagerload, 'author.missing')
+
+        for cls in (Company, User, Tag, BlogPost):
+            cls.drop_collection()
+
+    def test_windowed_eagerload(self):
+        class User(Document):
+            name = StringField()
+
+        class BlogPost(Document):
+            author = ReferenceField(User)
+
+        User.drop_collection()
+        BlogPost.drop_collection()
+
+        for i in xrange(5):
+            user = User(name='User #%d' % i)
+            user.save()
+            BlogPost(author=user).save()
+
+        posts = iter(BlogPost.objects.eagerload(BlogPost.author).batch_size(2))
+        first = next(posts)
+        User.drop_collection()
+        rest = list(posts)
+
+        self.assertEqual(len(rest), 4)
+        self.assertEqual(type(first._data['author']), User)
+        self.assertEqual(type(rest[0]._data['author']), User)
+        self.assertFalse(isinstance(rest[1]._data['author'], User))
+        self.assertTrue(first._siblings is rest[0]._siblings)
+        self.assertFalse(first._siblings is rest[1]._siblings)
+
+        BlogPost.drop_collection()
+
@@ -364,6 +364,49 @@ class FieldTest(unittest.TestCase):
         User.drop_collection()
         Group.drop_collection()
 
+    def test_sibling_dereference(self):
+        class User(documents.Document):
+            name = fields.StringField()
+
+        class Comment(documents.EmbeddedDocument):
+            by = fields.ReferenceField(User)
+
+        class Post(documents.Document):
+            author = fields.ReferenceField(User)
+            comments = fields.ListField(fields.EmbeddedDocumentField(Comment))
+
+        User.drop_collection()
+        Post.drop_collection()
+
+        users = [User(name='user%d' % i) for i in xrange(3)]
+
+        for user in users:
+            user.save()
+
+        for i in xrange(5):
+            Post(author=users[i % 3]).save()
+
+        users[2].delete()
+
+        posts = list(Post.objects.batch_size(3))
+        self.assertEqual(posts[0].author.name, 'user0')
+        self.assertTrue(isinstance(posts[1]._data['author'], User))
+        self.assertEqual(posts[2]._data['author'], None)
+        self.assertFalse(isinstance(posts[3]._data['author'], User))
+        self.assertEqual([post.author and post.author.name for post in posts], ['user0', 'user1', None, 'user0', 'user1'])
+
+        siblings = posts[3]._siblings
+        self.assertEqual(len(siblings.documents), 2)
+        del post, posts[4]
+        self.assertEqual(siblings.documents, [posts[3]])
+
+        post = Post(author=users[0], comments=[Comment(by=users[1])])
+        post.save()
+        self.assertEqual(Post.objects.with_id(post.id).comments[0].by.name, 'user1')
+
+        User.drop_collection()
+        Post.drop_collection()
+
     def test_list_item_dereference(self):
         class User(documents.Document):
             name = fields.StringField()
@@ -387,6 +430,24 @@ class FieldTest(unittest.TestCase):
         self.assertEqual(group_obj.members[0].name, user1.name)
         self.assertEqual(group_obj.members[1].name, user2.name)
 
+        users = [User(name='user%d' % i) for i in xrange(3, 8)]
+
+        for user in users:
+            user.save()
+
+        Group(members=[users[3], user1, users[0], users[3]] + users[4:]).save()
+        users[0].delete()
+
+        default_batch_size = fields.DEREFERENCE_BATCH_SIZE
+        fields.DEREFERENCE_BATCH_SIZE = 2
+
+        try:
+            group_obj = Group.objects.skip(1).first()
+            self.assertEqual([member and member.name for member in group_obj.members],
+                             ['user6', 'user1', None, 'user6', 'user7'])
+        finally:
+            fields.DEREFERENCE_BATCH_SIZE = default_batch_size
+
         User.drop_collection()
         Group.drop_collection()
 
@@ -1,8 +1,9 @@
 import unittest
 import pymongo
 from datetime import datetime
-from conjure import documents, fields, query, exceptions
+from conjure import documents, fields, query, exceptions, session, cache, spec
 import bson
+import json
 
 class QueryTest(unittest.TestCase):
     def setUp(self):
@@ -433,6 +434,209 @@ class QueryTest(unittest.TestCase):
 
         BlogPost.drop_collection()
 
+    def test_session(self):
+        class Author(documents.Document):
+            name = fields.StringField()
+
+        class BlogPost(documents.Document):
+            title = fields.StringField()
+            author = fields.ReferenceField(Author)
+
+        Author.drop_collection()
+        BlogPost.drop_collection()
+
+        author = Author(name='Test Author')
+        author.save()
+        BlogPost(title='Post #1', author=author).save()
+        BlogPost(title='Post #2', author=author).save()
+
+        first = BlogPost.objects.filter_by(title='Post #1').one()
+        self.assertFalse(first.author is BlogPost.objects.filter_by(title='Post #2').one().author)
+
+        with session.Session():
+            posts = BlogPost.objects.all()
+            self.assertTrue(posts[0].author is BlogPost.objects.filter_by(title='Post #2').one().author)
+            self.assertTrue(Author.objects.with_id(author.id) is posts[0].author)
+            self.assertTrue(BlogPost.objects.filter_by(title='Post #1').one() is posts[0])
+
+            posts = BlogPost.objects.eagerload(BlogPost.author).all()
+            self.assertTrue(posts[0].author is Author.objects.with_id(author.id))
+
+        self.assertFalse(Author.objects.with_id(author.id) is posts[0].author)
+
+        Author.drop_collection()
+        BlogPost.drop_collection()
+
+    def test_unit_of_work(self):
+        class BlogPost(documents.Document):
+            id = fields.StringField(db_field='_id')
+            title = fields.StringField()
+            hits = fields.IntegerField()
+
+        BlogPost.drop_collection()
+
+        post = BlogPost(id='1', title='Post #1', hits=0)
+        post.save(insert=True)
+        BlogPost(id='x', title='Deleted').save(insert=True)
+        post = BlogPost.objects.with_id('1')
+
+        with session.UnitOfWork(batch_size=2):
+            post.hits = 10
+            post.save()
+            post.save()
+
+            for i in range(2, 6):
+                BlogPost(id=str(i), title='Post #%d' % i).save(insert=True)
+
+            BlogPost.objects.with_id('x').delete()
+            self.assertEqual(BlogPost.objects.count(), 2)
+
+        self.assertEqual(BlogPost.objects.count(), 5)
+        self.assertEqual(BlogPost.objects.with_id('x'), None)
+        self.assertEqual(BlogPost.objects.with_id('1').hits, 10)
+        self.assertEqual(post._dirty, set())
+
+        duplicate = BlogPost(id='2', title='Duplicate')
+
+        def flush():
+            with session.UnitOfWork(ordered=False):
+                duplicate.save(insert=True)
+                BlogPost(id='6', title='Post #6').save(insert=True)
+
+        try:
+            flush()
+        except exceptions.BulkOperationError, e:
+            self.assertEqual(len(e.errors), 1)
+            self.assertTrue(e.errors[0][0] is duplicate)
+            self.assertTrue(isinstance(e.errors[0][1], exceptions.OperationError))
+        else:
+            self.fail()
+
+        self.assertEqual(BlogPost.objects.with_id('6').title, 'Post #6')
+
+        post = BlogPost.objects.with_id('3')
+
+        with session.UnitOfWork(ordered=False) as unit_of_work:
+            post.title = 'Changed'
+            post.save()
+            post.delete()
+            self.assertEqual([entry[2] for entry in unit_of_work._queue], [True])
+
+        self.assertEqual(BlogPost.objects.with_id('3'), None)
+
+        BlogPost.drop_collection()
+
+    def test_cache(self):
+        class Author(documents.Document):
+            name = fields.StringField()
+
+            class Meta:
+                cache = cache.LRUCache(max_size=2)
+
+        class BlogPost(documents.Document):
+            title = fields.StringField()
+            author = fields.ReferenceField(Author)
+
+        Author.drop_collection()
+        BlogPost.drop_collection()
+
+        authors = [Author(name='Author %d' % i) for i in range(3)]
+
+        for author in authors:
+            author.save()
+
+        BlogPost(title='Post #1', author=authors[0]).save()
+
+        author_cache = Author._meta['cache']
+        self.assertEqual(Author.objects.with_id(authors[0].id).name, 'Author 0')
+        self.assertEqual(len(author_cache), 1)
+
+        Author.objects._collection.update({'_id': authors[0].id}, {'$set': {'name': 'Stale'}})
+        self.assertEqual(Author.objects.with_id(authors[0].id).name, 'Author 0')
+        self.assertEqual(BlogPost.objects.one().author.name, 'Author 0')
+
+        bulk = Author.objects.in_bulk([author.id for author in authors])
+        self.assertEqual(sorted(bulk), sorted(author.id for author in authors))
+        self.assertEqual(bulk[authors[0].id].name, 'Author 0')
+        self.assertEqual(len(author_cache), 2)
+
+        author = Author.objects.with_id(authors[1].id)
+        author.name = 'Changed'
+        author.save()
+        self.assertEqual(Author.objects.with_id(authors[1].id).name, 'Changed')
+
+        Author.drop_collection()
+        BlogPost.drop_collection()
+
+    def test_iter_json(self):
+        class BlogPost(documents.Document):
+            title = fields.StringField()
+            hits = fields.IntegerField(internal=True)
+
+        BlogPost.drop_collection()
+
+        self.assertEqual(''.join(BlogPost.objects.iter_json()), '[]')
+
+        for i in range(5):
+            BlogPost(title='Post #%d' % i, hits=i).save()
+
+        chunks = list(BlogPost.objects.sort('+hits').iter_json(external=True, batch_size=2))
+        self.assertEqual(len(chunks), 4)
+
+        posts = json.loads(''.join(chunks))
+        self.assertEqual([post['title'] for post in posts], ['Post #%d' % i for i in range(5)])
+        self.assertTrue('hits' not in posts[0])
+        self.assertEqual(posts, [post.to_json(external=True) for post in BlogPost.objects.sort('+hits')])
+
+        BlogPost.drop_collection()
+
+    def test_prepare(self):
+        User = self.User
+
+        User.drop_collection()
+
+        for i in range(5):
+            User(name='User %d' % i, age=20 + i).save()
+
+        prepared = User.objects.filter(User.age >= spec.Param('min_age'), User.name.in_(spec.Param('names'))) \
+                               .sort('-age').only('name').prepare()
+
+        names = ['User 1', 'User 3', 'User 4']
+        self.assertEqual([user.name for user in prepared(min_age=22, names=names)], ['User 4', 'User 3'])
+        self.assertEqual([user.name for user in prepared(min_age=0, names=names)], ['User 4', 'User 3', 'User 1'])
+        self.assertEqual(prepared(min_age=0, names=names).first().age, None)
+        self.assertEqual(prepared(min_age=23, names=names).filter(User.age < 24).count(), 1)
+        self.assertRaises(KeyError, prepared, min_age=0)
+
+        prepared = User.objects.filter(User.age.in_([spec.Param('ages')])).prepare()
+        self.assertEqual(sorted(user.age for user in prepared(ages=[21, 23])), [21, 23])
+        self.assertEqual([user.age for user in prepared(ages=23)], [23])
+
+        class BlogPost(documents.Document):
+            author = fields.ReferenceField(User)
+
+        BlogPost.drop_collection()
+
+        authors = User.objects.sort('age').all()
+        posts = [BlogPost(author=author) for author in authors[:3]]
+
+        for post in posts:
+            post.save()
+
+        prepared = BlogPost.objects.filter(BlogPost.author == spec.Param('author')).prepare()
+        self.assertEqual(prepared(author=authors[1]).first().id, posts[1].id)
+        self.assertEqual(prepared(author=str(authors[2].id)).first().id, posts[2].id)
+
+        prepared = BlogPost.objects.filter(BlogPost.author.in_([spec.Param('authors')])).prepare()
+        self.assertEqual(sorted(post.id for post in prepared(authors=[authors[0], str(authors[2].id)])),
+                         sorted([posts[0].id, posts[2].id]))
+
+        prepared = BlogPost.objects.filter(BlogPost.author.nin(spec.Param('authors'))).prepare()
+        self.assertEqual([post.id for post in prepared(authors=authors[:2])], [posts[2].id])
+
+        BlogPost.drop_collection()
+        User.drop_collection()
+
     def test_chain_regex(self):
         class TextHolder(documents.Document):
             data = fields.StringField()
@@ -451,6 +655,39 @@ class QueryTest(unittest.TestCase):
 
         self.assertEqual(len(obs), 2)
 
+    def test_lazy(self):
+        class Comment(documents.EmbeddedDocument):
+            content = fields.StringField()
+
+        class BlogPost(documents.Document):
+            title = fields.StringField()
+            hits = fields.IntegerField()
+            comments = fields.ListField(fields.EmbeddedDocumentField(Comment))
+
+        BlogPost.drop_collection()
+
+        BlogPost(title='Test Post', hits=5, comments=[Comment(content='test')]).save()
+
+        post = BlogPost.objects.lazy().one()
+        self.assertEqual(post._data, {})
+
+        self.assertEqual(post.title, 'Test Post')
+        self.assertEqual(post._data, {'title': 'Test Post'})
+
+        post.hits = 6
+        mongo = post.to_mongo()
+        self.assertEqual(mongo['hits'], 6)
+        self.assertEqual(mongo['comments'], [{'content': 'test'}])
+        self.assertFalse('comments' in post._data)
+
+        del post.comments
+        self.assertEqual(post.comments, [])
+
+        post = BlogPost.objects.one()
+        self.assertTrue('comments' in post._data)
+
+        BlogPost.drop_collection()
+
     def test_change_tracking(self):
         user = self.User(name='Andrew', age=31)
         user.save()
@@ -460,6 +697,32 @@ class QueryTest(unittest.TestCase):
         user.name = 'Tom'
         self.assertEqual(user._base.name, 'Andrew')
 
+    def test_change_tracking_mutation(self):
+        class BlogPost(documents.Document):
+            title = fields.StringField()
+            tags = fields.ListField(fields.StringField())
+            info = fields.DictField()
+
+            class Meta:
+                track_changes = True
+
+        BlogPost.drop_collection()
+
+        BlogPost(title='Test Post', tags=['a', 'b'], info={'views': 1}).save()
+
+        post = BlogPost.objects.one()
+        self.assertEqual(post.deltas(), {})
+
+        post.tags.append('c')
+        post.info['views'] = 2
+
+        deltas = post.deltas()
+        self.assertEqual(deltas['tags']['added'], ['c'])
+        self.assertEqual(deltas['info'], {'old': {'views': 1}, 'new': {'views': 2}})
+        self.assertFalse('title' in deltas)
+
+        BlogPost.drop_collection()
+
     def tearDown(self):
         self.User.drop_collection()
 
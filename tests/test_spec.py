@@ -155,6 +155,126 @@ class SpecTest(unittest.TestCase):
         spec |= User.followers == 4
         self.assertEqual(spec, {'$or': [{'followers': 2}, {'followers': 3}, {'followers': 4}]})
 
+    def test_sharing(self):
+        spec = (User.followers == 2) | (User.followers == 3)
+        extended = spec | (User.followers == 4)
+        merged = spec & ((User.age == 5) | (User.age == 6))
+
+        self.assertEqual(spec, {'$or': [{'followers': 2}, {'followers': 3}]})
+        self.assertEqual(extended, {'$or': [{'followers': 2}, {'followers': 3}, {'followers': 4}]})
+        self.assertEqual(merged, {'$or': [{'followers': 2}, {'followers': 3}, {'age': 5}, {'age': 6}]})
+
+        update = User.followers + [2, 5]
+        combined = update & User.followers + [8]
+
+        self.assertEqual(update, {'$pushAll': {'followers': [2, 5]}})
+        self.assertEqual(combined, {'$pushAll': {'followers': [2, 5, 8]}})
+        self.assertFalse(combined.empty())
+
+    def test_expression_keys(self):
+        spec = User.age > 5
+
+        self.assertEqual(spec.expressions.keys(), [('age', ('gt',))])
+        self.assertEqual((~(User.age >= 5)).expressions.keys(), [('age', ('lte',))])
+        self.assertEqual((~(User.age == 5)).expressions.keys(), [('age', ('ne',))])
+        self.assertEqual((~(User.age % 5 == 2)).expressions.keys(), [('age', ('not', 'mod'))])
+
+        self.assertEqual((Settings.sound == True).compile(prefix='settings'), {'sound': True})
+        self.assertEqual((Settings.sound == True).compile(prefix='set'), {'settings.sound': True})
+
+    def test_optimize(self):
+        self.assertEqual(User.followers.in_([2]), {'followers': 2})
+        self.assertEqual(User.followers.nin([2]), {'followers': {'$ne': 2}})
+        self.assertEqual((User.age > 5) & (User.age >= 7), {'age': {'$gte': 7}})
+        self.assertEqual((User.age > 5) & (User.age >= 5) & (User.age <= 9) & (User.age < 9), {'age': {'$gt': 5, '$lt': 9}})
+        self.assertEqual(~(User.age == 5) | ~User.age.in_([1, 2]), {'$or': [{'age': {'$ne': 5}}, {'age': {'$nin': [1, 2]}}]})
+        self.assertEqual(~conjure.spec.QuerySpecification(['age', '', 5]), {'age': {'$ne': 5}})
+        self.assertEqual(conjure.spec.optimize({'$or': [{'$or': [{'age': 1}, {'age': 2}]}, {'age': 3}]}),
+                         {'$or': [{'age': 1}, {'age': 2}, {'age': 3}]})
+
+        debug = ((User.age > 5) & (User.age >= 7)).debug()
+        self.assertEqual(debug['original'], {'age': {'$gt': 5, '$gte': 7}})
+        self.assertEqual(debug['optimized'], {'age': {'$gte': 7}})
+
+        param = conjure.spec.Param('ages')
+        self.assertEqual(User.age.in_([param]), {'age': {'$in': [param]}})
+
+        debug = User.widgets.match(Widget.index.in_([3])).debug()
+        self.assertEqual(debug['original'], {'widgets': {'$elemMatch': {'index': {'$in': [3]}}}})
+        self.assertEqual(debug['optimized'], {'widgets': {'$elemMatch': {'index': 3}}})
+        self.assertEqual(conjure.spec.optimize({'followers': {'$elemMatch': {'$in': [3]}}}),
+                         {'followers': {'$elemMatch': {'$in': [3]}}})
+        self.assertEqual(conjure.spec.optimize({'followers': {'$elemMatch': {'$gt': 2, '$gte': 3}}}),
+                         {'followers': {'$elemMatch': {'$gte': 3}}})
+        self.assertEqual(conjure.spec.optimize({'age': {'$not': {'$in': [3]}}}), {'age': {'$ne': 3}})
+
+    def test_matches(self):
+        user = User(username='stan', age=30, followers=[1, 2, 3], widgets=[Widget(index=2), Widget(index=7)])
+        user.settings = Settings(sound=False)
+
+        self.assertTrue((User.username == 'stan').matches(user))
+        self.assertFalse((User.username != 'stan').matches(user))
+        self.assertTrue(User.username.istartswith('ST').matches(user))
+        self.assertTrue(((User.age > 20) & (User.age <= 30)).matches(user))
+        self.assertFalse((User.age < 30).matches(user))
+        self.assertTrue((User.followers == 2).matches(user))
+        self.assertTrue(User.followers.in_([5, 3]).matches(user))
+        self.assertFalse(User.followers.nin([5, 3]).matches(user))
+        self.assertTrue(User.followers.all([1, 3]).matches(user))
+        self.assertTrue(User.followers.size(3).matches(user))
+        self.assertTrue(User.age.exists().matches(user))
+        self.assertFalse(User.email.exists().matches(user))
+        self.assertTrue((~User.email.exists()).matches(user))
+        self.assertTrue(User.username.type(conjure.STRING).matches(user))
+        self.assertTrue((User.age % 7 == 2).matches(user))
+        self.assertTrue((User.age % 7 != 3).matches(user))
+        self.assertTrue(User.widgets.match(Widget.index > 5).matches(user))
+        self.assertFalse(User.widgets.match(Widget.index > 5, Widget.index < 7).matches(user))
+        self.assertTrue((Settings.sound == False).matches(user))
+        self.assertTrue(((User.age == 5) | (User.followers == 3)).matches(user))
+        self.assertFalse(((User.age == 5) | (User.followers == 4)).matches(user))
+        self.assertTrue((User.email == None).matches({'username': 'stan'}))
+
+        spec = User.age >= 18
+        self.assertEqual(filter(spec.predicate(), [{'age': 10}, {'age': 20}, {}]), [{'age': 20}])
+
+    def test_apply(self):
+        doc = {'username': 'stan', 'age': 30, 'followers': [1, 2, 3, 2], 'following': [5, 6],
+               'widgets': [{'index': 2}, {'index': 7}]}
+
+        update = User.username.set('stanislav') & User.age.inc(2) & (User.followers - 2) & User.following.popleft()
+        update &= (User.followers | 3) & (User.followers | 4) & User.email.unset()
+        self.assertTrue(update.apply(doc) is doc)
+        self.assertEqual(doc['username'], 'stanislav')
+        self.assertEqual(doc['age'], 32)
+        self.assertEqual(doc['followers'], [1, 3, 4])
+        self.assertEqual(doc['following'], [6])
+
+        (User.followers + [7, 8] & User.following.pull_all([6]) & User.email.set('stan@example.com')).apply(doc)
+        self.assertEqual(doc['followers'], [1, 3, 4, 7, 8])
+        self.assertEqual(doc['following'], [])
+        self.assertEqual(doc['email'], 'stan@example.com')
+
+        User.widgets.pull(Widget.index > 5).apply(doc)
+        self.assertEqual(doc['widgets'], [{'index': 2}])
+
+        Widget.index.set(4).apply(doc, User.widgets.match(Widget.index == 2))
+        self.assertEqual(doc['widgets'], [{'index': 4}])
+        self.assertRaises(conjure.exceptions.InvalidQueryError, Widget.index.set(1).apply, doc, Widget.index == 9)
+
+        doc = {'followers': [1], 'age': 30}
+        update = {'$inc': {'age': 1}, '$push': {'followers': {'$each': [2, 3], '$slice': -2}}}
+        self.assertRaises(conjure.exceptions.InvalidQueryError, conjure.updater.apply_update, doc, update)
+        self.assertEqual(doc, {'followers': [1], 'age': 30})
+        conjure.updater.apply_update(doc, {'$push': {'followers': {'$each': [2, 3]}}})
+        self.assertEqual(doc['followers'], [1, 2, 3])
+
+        user = User(username='stan', age=30, settings=Settings(sound=False))
+        (User.age.inc() & Settings.sound.set(True) & User.followers.push(5)).apply(user)
+        self.assertEqual(user.age, 31)
+        self.assertTrue(user.settings.sound)
+        self.assertEqual(user.followers, [5])
+
     def test_elem_match(self):
         self.assertEqual(User.widgets.match(Widget.index == 5), {'widgets': {'$elemMatch': {'index': 5}}})
         self.assertEqual(User.widgets.match(Widget.index < 2, Widget.index > 5), {'widgets': {'$elemMatch': {'index': {'$lt': 2, '$gt': 5}}}})